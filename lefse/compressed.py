@@ -0,0 +1,25 @@
+import gzip,bz2,lzma
+
+# compressed files are recognized by their magic bytes when read and by
+# their extension when written, and (de)compressed on the fly with the
+# codecs of the standard library. This module only needs the standard
+# library so that lefsebiom can use it without loading lefse.lefse
+compressions = [('.gz',b'\x1f\x8b',gzip),('.bz2',b'BZh',bz2),('.xz',b'\xfd7zXZ\x00',lzma)]
+
+def compression(filename):
+    with open(filename,'rb') as inp:
+        head = inp.read(6)
+    for ext,magic,codec in compressions:
+        if head.startswith(magic): return codec
+    return None
+
+def uncompressed_name(filename):
+    for ext,magic,codec in compressions:
+        if filename.endswith(ext): return filename[:-len(ext)]
+    return filename
+
+def open_compressed(filename,mode='rt'):
+    if 'r' in mode: codec = compression(filename)
+    else: codec = dict([(ext,codec) for ext,magic,codec in compressions]).get(filename[len(uncompressed_name(filename)):])
+    if codec is None: return open(filename,mode)
+    return codec.open(filename,mode if 'b' in mode or 't' in mode else mode+'t')
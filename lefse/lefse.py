@@ -1,29 +1,104 @@
-import os,sys,math,pickle
+import os,sys,math,pickle,json,mmap,multiprocessing
+from multiprocessing import shared_memory
+import hashlib,shutil,time
 import random as lrand
-import rpy2.robjects as robjects
 import argparse
 import numpy
+import scipy.stats
+import scipy.sparse
+from lefse.compressed import compressions,compression,uncompressed_name,open_compressed
 #import svmutil
 
+# R is started (through rpy2) and its libraries are loaded only when an R
+# implementation of a step is first used
+robjects = None
+r_libs = []
+coin_libs = ['splines','stats4','survival','mvtnorm','modeltools','coin']
+
 def init():
     lrand.seed(1982)
-    robjects.r('library(splines)')
-    robjects.r('library(stats4)')
-    robjects.r('library(survival)')
-    robjects.r('library(mvtnorm)')
-    robjects.r('library(modeltools)')
-    robjects.r('library(coin)')
-    robjects.r('library(MASS)')
+
+def init_r(*libs):
+    global robjects
+    if robjects is None:
+        import rpy2.robjects
+        robjects = rpy2.robjects
+    for l in libs:
+        if l not in r_libs:
+            robjects.r('library('+l+')')
+            r_libs.append(l)
+
+class FeatureMatrix:
+    # features x samples float64 matrix with a name -> row index, it can be
+    # used as the name -> values dict of the previous versions and its rows
+    # are views on the matrix. The matrix can also be a scipy.sparse CSR
+    # matrix, in which case the rows are returned as dense copies
+    def __init__(self,names,data):
+        self.names = list(names)
+        self.index = dict([(n,i) for i,n in enumerate(self.names)])
+        self.data = data
+    def __getitem__(self,name):
+        if scipy.sparse.issparse(self.data): return self.data[self.index[name]].toarray().ravel()
+        return self.data[self.index[name]]
+    def __contains__(self,name):
+        return name in self.index
+    def __iter__(self):
+        return iter(self.names)
+    def __len__(self):
+        return len(self.names)
+    def keys(self):
+        return list(self.names)
+    def values(self):
+        return [self[n] for n in self.names]
+    def items(self):
+        return zip(self.names,self.values())
+    def subset(self,names):
+        return FeatureMatrix(names,self.data[[self.index[n] for n in names]])
+    def dense(self):
+        if not scipy.sparse.issparse(self.data): return self
+        return FeatureMatrix(self.names,self.data.toarray())
+
+# The feature matrix is passed to the worker processes by reference: a matrix
+# memory-mapped from a file (as the ones of load_data) is mapped again by the
+# workers, any other one is copied once in a shared memory block the workers
+# attach to, so its memory is not replicated in each worker.
+shared_blocks = []
+
+def share_matrix(x):
+    # returns the reference to x (dense or CSR) for attach_matrix and the
+    # shared memory blocks to be released (release_shared) after the workers
+    if scipy.sparse.issparse(x):
+        x = scipy.sparse.csr_matrix(x)
+        refs = [share_matrix(a) for a in (x.data,x.indices,x.indptr)]
+        return ('csr',[r for r,b in refs],x.shape),[bb for r,b in refs for bb in b]
+    if isinstance(x,numpy.memmap) and isinstance(x.base,mmap.mmap) and x.mode == 'r':
+        return ('mmap',x.filename,x.offset,x.dtype.str,x.shape),[]
+    x = numpy.ascontiguousarray(x)
+    if x.size == 0: return ('copy',x),[]
+    shm = shared_memory.SharedMemory(create=True,size=x.nbytes)
+    numpy.ndarray(x.shape,dtype=x.dtype,buffer=shm.buf)[...] = x
+    return ('shm',shm.name,x.dtype.str,x.shape),[shm]
+
+def attach_matrix(ref):
+    if ref[0] == 'csr': return scipy.sparse.csr_matrix(tuple([attach_matrix(r) for r in ref[1]]),shape=ref[2])
+    if ref[0] == 'mmap': return numpy.memmap(ref[1],dtype=ref[3],mode='r',offset=ref[2],shape=ref[4])
+    if ref[0] == 'copy': return ref[1]
+    shm = shared_memory.SharedMemory(name=ref[1])
+    shared_blocks.append(shm)
+    return numpy.ndarray(ref[3],dtype=ref[2],buffer=shm.buf)
+
+def release_shared(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
 
 def get_class_means(class_sl,feats):
-    means = {}
     clk = list(class_sl.keys())
-    for fk,f in feats.items():
-        means[fk] = [numpy.mean((f[class_sl[k][0]:class_sl[k][1]])) for k in clk]
-    return clk,means
+    means = numpy.array([numpy.asarray(feats.data[:,class_sl[k][0]:class_sl[k][1]].mean(axis=1)).ravel() for k in clk]).T
+    return clk,FeatureMatrix(feats.names,means)
 
 def save_res(res,filename):
-    with open(filename, 'w') as out:
+    with open_compressed(filename, 'wt') as out:
         for k,v in res['cls_means'].items():
             out.write(k+"\t"+str(math.log(max(max(v),1.0),10.0))+"\t")
             if k in res['lda_res_th']:
@@ -35,19 +110,253 @@ def save_res(res,filename):
             else: out.write("\t")
             out.write( "\t" + (res['wilcox_res'][k] if 'wilcox_res' in res and k in res['wilcox_res'] else "-")+"\n")
 
+# Typed results (written by lefse_run.py with --output_bin): a LEfSe binary
+# file (see below) with "format" "res", "names" the features, "classes" the
+# classes (cls_means_kord) and one entry per feature in the arrays
+# "cls_means" (features x classes), "kw_pv" (KW p-value), "wilc_ok" (outcome
+# of the Wilcoxon tests: 1 passed, 0 failed, -1 not run because the KW test
+# failed or with --wilc 0), "lda"
+# (LDA score, NaN if not computed), "lda_sd" (standard deviation of the LDA
+# score over the bootstrap iterations, NaN if not computed), "biomarker"
+# (LDA score above the threshold) and "lda_class" (index in "classes" of the
+# class with the highest mean for the biomarkers, -1 otherwise).
+
+def save_res_bin(res,filename):
+    fk = res['cls_means'].keys()
+    means = numpy.array(res['cls_means'].values(),dtype=float).reshape(len(fk),len(res['cls_means_kord']))
+    biom = [k in res['lda_res_th'] for k in fk]
+    arrays = [('cls_means','<f8',means.shape,[means]),
+              ('kw_pv','<f8',(len(fk),),[numpy.array([res['kw_pv'].get(k,float('nan')) for k in fk],dtype=float)]),
+              ('wilc_ok','|i1',(len(fk),),[numpy.array([res['wilc_ok'].get(k,-1) for k in fk],dtype=numpy.int8)]),
+              ('lda','<f8',(len(fk),),[numpy.array([res['lda_res'].get(k,float('nan')) for k in fk],dtype=float)]),
+              ('lda_sd','<f8',(len(fk),),[numpy.array([res['lda_sd'].get(k,float('nan')) for k in fk],dtype=float)]),
+              ('biomarker','|b1',(len(fk),),[numpy.array(biom,dtype=bool)]),
+              ('lda_class','<i8',(len(fk),),[numpy.where(biom,means.argmax(axis=1) if len(fk) else [],-1)])]
+    save_bin(filename,{'format':'res','version':1,'names':fk,'classes':list(res['cls_means_kord'])},arrays)
+
+def load_res_bin(filename):
+    # returns the header, the arrays and the name -> row index of the features
+    header,arrays = load_bin(filename)
+    return header,arrays,dict([(n,i) for i,n in enumerate(header['names'])])
+
+def res_rows(filename):
+    # the fields of the lines of the results (text or typed) as in the text
+    # format: feature, log10 of the highest class mean, class, LDA score (the
+    # last two empty if not a biomarker) and Wilcoxon column
+    if not is_bin(filename):
+        with open_compressed(filename,'rt') as inp:
+            return [line.strip().split('\t') for line in inp if line.strip()]
+    header,arrays,index = load_res_bin(filename)
+    rows = []
+    for i,k in enumerate(header['names']):
+        m = arrays['cls_means'][i]
+        biom = bool(arrays['biomarker'][i])
+        rows.append([k,str(math.log(max(float(m.max()),1.0),10.0)),
+                     header['classes'][arrays['lda_class'][i]] if biom else "",str(float(arrays['lda'][i])) if biom else "",
+                     str(float(arrays['kw_pv'][i])) if arrays['wilc_ok'][i] == 1 else "-"])
+    return rows
+
+# LEfSe binary files (the .in files written by lefse_format_input.py)
+#
+#   bytes 0-7          the magic string LEFSEBIN
+#   bytes 8-15         length H of the header (little-endian unsigned 64-bit)
+#   bytes 16-(16+H)    the header, a UTF-8 JSON object
+#   zero padding up to the next multiple of 64 bytes, where the data starts
+#   the arrays, each one raw and in C order
+#
+# The whole file can be compressed (gz, bz2 or xz, chosen by the extension of
+# the file name), in which case it is decompressed in memory when loaded
+# instead of being memory-mapped.
+#
+# The header has a "format" entry ("data" for the formatted input), the
+# "arrays" entry giving for each array its "dtype" (numpy notation), its
+# "shape" and its "offset" in bytes from the start of the data, and the
+# other metadata of the file. For the formatted input these are "names",
+# the feature names (one per row of the "feats" array, a features x samples
+# '<f8' matrix), "cls", "class_sl", "subclass_sl", "class_hierarchy" and
+# "norm", with the same content of the entries of the pickled dict written
+# by the previous versions (which can still be read by load_data). Sparse
+# inputs have "sparse": "csr" and "shape" in the header and, in place of
+# "feats", the "data", "indices" and "indptr" arrays of the CSR matrix.
+
+bin_magic = b'LEFSEBIN'
+
+def is_bin(filename):
+    with open_compressed(filename,'rb') as inp:
+        return inp.read(len(bin_magic)) == bin_magic
+
+def save_bin(filename,header,arrays):
+    # arrays is a list of (name,dtype,shape,chunks) with chunks an iterable of
+    # arrays written one after the other to fill the array
+    header = dict(header)
+    header['arrays'] = {}
+    off = 0
+    for name,dtype,shape,chunks in arrays:
+        header['arrays'][name] = {'dtype':numpy.dtype(dtype).str,'shape':list(shape),'offset':off}
+        off += int(numpy.prod(shape))*numpy.dtype(dtype).itemsize
+    hb = json.dumps(header).encode('utf-8')
+    start = (len(bin_magic)+8+len(hb)+63)//64*64
+    with open_compressed(filename,'wb') as out:
+        out.write(bin_magic+numpy.array(len(hb),dtype='<u8').tobytes()+hb)
+        out.write(b'\0'*(start-len(bin_magic)-8-len(hb)))
+        for name,dtype,shape,chunks in arrays:
+            for c in chunks:
+                out.write(numpy.ascontiguousarray(c,dtype=header['arrays'][name]['dtype']).tobytes())
+
+def load_bin(filename):
+    # the arrays are memory-mapped (read-only), so they are paged in lazily,
+    # a compressed file is instead decompressed in memory
+    codec = compression(filename)
+    with open_compressed(filename,'rb') as inp:
+        inp.read(len(bin_magic))
+        hl = int(numpy.frombuffer(inp.read(8),dtype='<u8')[0])
+        header = json.loads(inp.read(hl).decode('utf-8'))
+        start = (len(bin_magic)+8+hl+63)//64*64
+        if codec is not None:
+            inp.read(start-len(bin_magic)-8-hl)
+            buf = inp.read()
+    arrays = {}
+    for name,a in header['arrays'].items():
+        if numpy.prod(a['shape']) == 0: arrays[name] = numpy.zeros(a['shape'],dtype=a['dtype'])
+        elif codec is not None: arrays[name] = numpy.frombuffer(buf,dtype=a['dtype'],count=int(numpy.prod(a['shape'])),offset=a['offset']).reshape(a['shape'])
+        else: arrays[name] = numpy.memmap(filename,dtype=a['dtype'],mode='r',offset=start+a['offset'],shape=tuple(a['shape']))
+    return header,arrays
+
+def save_data(out,filename):
+    feats = out['feats']
+    header = {'format':'data','version':1,'names':list(feats.keys()),'cls':out['cls'],'norm':out['norm'],
+              'class_sl':out['class_sl'],'subclass_sl':out['subclass_sl'],'class_hierarchy':out['class_hierarchy']}
+    ns = len(list(out['cls'].values())[0])
+    if scipy.sparse.issparse(feats.data):
+        x = scipy.sparse.csr_matrix(feats.data)
+        header['sparse'],header['shape'] = 'csr',[len(feats),ns]
+        save_bin(filename,header,[('data','<f8',x.data.shape,[x.data]),('indices','<i8',x.indices.shape,[x.indices]),
+                                  ('indptr','<i8',x.indptr.shape,[x.indptr])])
+    else: save_bin(filename,header,[('feats','<f8',(len(feats),ns),feats.values())])
+
 def load_data(input_file, nnorm = False):
-    with open(input_file, 'rb') as inputf:
-        inp = pickle.load(inputf)
+    if is_bin(input_file):
+        header,arrays = load_bin(input_file)
+        inp = dict([(k,header[k]) for k in ['cls','norm','class_hierarchy']])
+        for k in ['class_sl','subclass_sl']:
+            inp[k] = dict([(c,tuple(v)) for c,v in header[k].items()])
+        if header.get('sparse') == 'csr':
+            x = scipy.sparse.csr_matrix((arrays['data'],arrays['indices'],arrays['indptr']),shape=tuple(header['shape']))
+            inp['feats'] = FeatureMatrix(header['names'],x)
+        else: inp['feats'] = FeatureMatrix(header['names'],arrays['feats'])
+    else:
+        with open_compressed(input_file, 'rb') as inputf:
+            inp = pickle.load(inputf)
+        inp['feats'] = FeatureMatrix(inp['feats'].keys(),numpy.array(list(inp['feats'].values()),dtype=float))
     if nnorm: return inp['feats'],inp['cls'],inp['class_sl'],inp['subclass_sl'],inp['class_hierarchy'],inp['norm']
     else: return inp['feats'],inp['cls'],inp['class_sl'],inp['subclass_sl'],inp['class_hierarchy']
 
 def load_res(input_file):
-    with open(input_file, 'rb') as inputf:
+    with open_compressed(input_file, 'rb') as inputf:
         inp = pickle.load(inputf)
     return inp['res'],inp['params'],inp['class_sl'],inp['subclass_sl']
 
+# Result cache: a directory with the result files of previous runs named after
+# the SHA-256 of the content of their input file and of the parameters that
+# affect the result. The entries expire after max_age days and the least
+# recently used ones are evicted when the cache exceeds max_size MB.
+
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename,'rb') as inp:
+        for b in iter(lambda: inp.read(1<<20),b''):
+            h.update(b)
+    return h.hexdigest()
+
+def cache_key(input_file,params):
+    h = hashlib.sha256(file_hash(input_file).encode('utf-8'))
+    h.update(json.dumps(params,sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+def cache_get(cache_dir,key,outputs,max_age):
+    # copies the cached results to the output files (outputs is a list of
+    # (suffix,filename) as given to cache_put), returns False if not cached
+    entries = [os.path.join(cache_dir,key+sf) for sf,fn in outputs]
+    if not all([os.path.exists(e) for e in entries]): return False
+    if time.time()-min([os.path.getmtime(e) for e in entries]) > max_age*86400.0:
+        for e in entries: os.remove(e)
+        return False
+    for e,(sf,fn) in zip(entries,outputs):
+        os.utime(e,None)
+        with open(e,'rb') as inp, open_compressed(fn,'wb') as out:
+            shutil.copyfileobj(inp,out)
+    return True
+
+def cache_put(cache_dir,key,outputs,max_size,max_age):
+    os.makedirs(cache_dir,exist_ok=True)
+    for sf,fn in outputs:
+        entry = os.path.join(cache_dir,key+sf)
+        with open_compressed(fn,'rb') as inp, open(entry+'.tmp'+str(os.getpid()),'wb') as out:
+            shutil.copyfileobj(inp,out)
+        os.replace(entry+'.tmp'+str(os.getpid()),entry)
+    # the files of an entry (named after the same key) are evicted together
+    keys = {}
+    for e in os.listdir(cache_dir):
+        if '.tmp' in e: continue
+        fe = os.path.join(cache_dir,e)
+        k = e.split('.')[0]
+        sz,mt = keys.get(k,(0,0.0))
+        keys[k] = (sz+os.path.getsize(fe),max(mt,os.path.getmtime(fe)))
+    tot = 0
+    for k in sorted(keys,key=lambda k: keys[k][1],reverse=True):
+        tot += keys[k][0]
+        if k != key and (tot > max_size*1048576.0 or time.time()-keys[k][1] > max_age*86400.0):
+            for e in os.listdir(cache_dir):
+                if e.split('.')[0] == k: os.remove(os.path.join(cache_dir,e))
+
+
+# Stage files keep the raw outputs of the steps of lefse_run (a LEfSe binary
+# file with "format" "stages"): the SHA-256 of the input file in "input" and,
+# in "stages", the parameters each stage was computed with. The outputs of a
+# stage s are the arrays "s.k" (given as the entry k of the stage dict), e.g.
+# "kw.ind" and "kw.pv" the KW p-values of the features (indexes) tested,
+# "wilc.ind" and "wilc.ok" the Wilcoxon outcomes of the features tested,
+# "lda.ind" and "lda.scores" the LDA scores (bootstraps x class pairs x
+# features) of the features ranked. The checkpoints of lefse_run are stage
+# files too, with the outputs computed so far. They are written to a
+# temporary file moved in place once complete, so an interrupted write
+# leaves the previous file intact, and a file that can't be read is taken
+# as no stages.
+
+def save_stages(filename,input_hash,stages):
+    header = {'format':'stages','version':1,'input':input_hash,'stages':dict([(s,v['params']) for s,v in stages.items()])}
+    arrays = []
+    for s,v in sorted(stages.items()):
+        for k,a in sorted(v.items()):
+            if k == 'params': continue
+            a = numpy.asarray(a)
+            arrays.append((s+'.'+k,a.dtype.newbyteorder('<'),a.shape,[a]))
+    # the temporary name keeps the compression extension of filename
+    base = uncompressed_name(filename)
+    tmp = base+'.tmp'+str(os.getpid())+filename[len(base):]
+    try:
+        save_bin(tmp,header,arrays)
+        os.replace(tmp,filename)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+def load_stages(filename,input_hash):
+    # the stages stored in filename if it exists, can be read and refers to
+    # the same input
+    try:
+        if not os.path.exists(filename) or not is_bin(filename): return {}
+        header,arrays = load_bin(filename)
+        if header.get('format') != 'stages' or header['input'] != input_hash: return {}
+        stages = dict([(s,{'params':p}) for s,p in header['stages'].items()])
+        for n,a in arrays.items():
+            s,k = n.split('.',1)
+            stages[s][k] = numpy.array(a)
+    except Exception:
+        return {}
+    return stages
 
 def test_kw_r(cls,feats,p,factors):
+    init_r()
     robjects.globalenv["y"] = robjects.FloatVector(feats)
     for i,f in enumerate(factors):
         robjects.globalenv['x'+str(i+1)] = robjects.FactorVector(robjects.StrVector(cls[f]))
@@ -59,7 +368,142 @@ def test_kw_r(cls,feats,p,factors):
     kw_res = robjects.r('kruskal.test('+fo+',)$p.value')
     return float(tuple(kw_res)[0]) < p, float(tuple(kw_res)[0])
 
-def test_rep_wilcoxon_r(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,comp_only_same_subcl,curv=False):
+def _rank_sums(x,grp,ngrp):
+    # row-wise average ranks (ties get the mean rank, as in R's rank()) summed
+    # within each group, plus the per-row tie term sum(t^3-t) used by the
+    # tie corrections of the rank tests
+    if scipy.sparse.issparse(x): return _rank_sums_sparse(x,grp,ngrp)
+    n = x.shape[1]
+    o = numpy.argsort(x,axis=1,kind='mergesort')
+    s = numpy.take_along_axis(x,o,axis=1)
+    pos = numpy.arange(n)
+    first = numpy.ones(s.shape,dtype=bool)
+    first[:,1:] = s[:,1:] != s[:,:-1]
+    last = numpy.ones(s.shape,dtype=bool)
+    last[:,:-1] = first[:,1:]
+    start = numpy.maximum.accumulate(numpy.where(first,pos,0),axis=1)
+    end = numpy.minimum.accumulate(numpy.where(last,pos,n-1)[:,::-1],axis=1)[:,::-1]
+    ranks = numpy.empty(s.shape)
+    numpy.put_along_axis(ranks,o,(start+end)*0.5+1.0,axis=1)
+    t = (end-start+1).astype(float)
+    ind = numpy.zeros((n,ngrp))
+    ind[pos,grp] = 1.0
+    return numpy.dot(ranks,ind), (t*t-1.0).sum(axis=1), ind.sum(axis=0)
+
+def _rank_sums_sparse(x,grp,ngrp):
+    # same as _rank_sums for a CSR matrix without densifying it: only the
+    # non-zero entries are sorted, the zeros of a row are a single tie group
+    # whose average rank (after the negative values) is known in closed form
+    x = scipy.sparse.csr_matrix(x,copy=True)
+    x.sum_duplicates()
+    x.eliminate_zeros()
+    m,n = x.shape
+    row = numpy.repeat(numpy.arange(m),numpy.diff(x.indptr))
+    o = numpy.lexsort((x.data,row))
+    s,r,c = x.data[o],row[o],x.indices[o]
+    pos = numpy.arange(len(s))
+    first = numpy.ones(len(s),dtype=bool)
+    first[1:] = (s[1:] != s[:-1]) | (r[1:] != r[:-1])
+    last = numpy.ones(len(s),dtype=bool)
+    last[:-1] = first[1:]
+    start = numpy.maximum.accumulate(numpy.where(first,pos,0)) if len(s) else pos
+    end = numpy.minimum.accumulate(numpy.where(last,pos,len(s)-1)[::-1])[::-1] if len(s) else pos
+    nz = (n-numpy.diff(x.indptr)).astype(float)
+    nneg = numpy.bincount(r,weights=s<0,minlength=m)
+    ranks = (start+end)*0.5-x.indptr[r]+1.0+numpy.where(s>0,nz[r],0.0)
+    t = (end-start+1).astype(float)
+    ties = numpy.bincount(r,weights=t*t-1.0,minlength=m)+nz**3-nz
+    cnt = numpy.bincount(grp,minlength=ngrp).astype(float)
+    gi = r*ngrp+numpy.asarray(grp)[c]
+    rs = numpy.bincount(gi,weights=ranks,minlength=m*ngrp).reshape(m,ngrp)
+    nzc = cnt-numpy.bincount(gi,minlength=m*ngrp).reshape(m,ngrp)
+    return rs+(nneg+(nz+1.0)*0.5)[:,None]*nzc, ties, cnt
+
+def test_kw_native(cls,feats,p,factors,block=4096):
+    # batched equivalent of test_kw_r: feats is a features x samples matrix,
+    # returns the accept flags and the p-values of all the features
+    if not scipy.sparse.issparse(feats): feats = numpy.asarray(feats,dtype=float)
+    lev,grp = numpy.unique(list(cls[factors[0]]),return_inverse=True)
+    n = feats.shape[1]
+    pv = numpy.empty(feats.shape[0])
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        for b in range(0,feats.shape[0],block):
+            rs,ties,cnt = _rank_sums(feats[b:b+block],grp,len(lev))
+            h = 12.0*(rs*rs/cnt).sum(axis=1)/(n*(n+1.0)) - 3.0*(n+1.0)
+            h /= 1.0 - ties/(float(n)**3-n)
+            pv[b:b+block] = scipy.stats.chi2.sf(h,len(lev)-1)
+    return pv < p, pv
+
+def wilcoxon_pairs(sl,cl_hie,min_c,comp_only_same_subcl):
+    # the subclass pairs on which test_rep_wilcoxon_r can run the rank-sum test
+    prs = []
+    for pair in [(x,y) for x in cl_hie.keys() for y in cl_hie.keys() if x < y]:
+        for k1 in cl_hie[pair[0]]:
+            for k2 in cl_hie[pair[1]]:
+                if comp_only_same_subcl and k1[len(pair[0]):] != k2[len(pair[1]):]: continue
+                if sl[k1][1]-sl[k1][0] < min_c or sl[k2][1]-sl[k2][0] < min_c: continue
+                prs.append((k1,k2))
+    return prs
+
+def test_wilcoxon_native(sl,cl_hie,feats,min_c,comp_only_same_subcl,block=4096):
+    # asymptotic two-sided p-values of the rank-sum test (with tie correction,
+    # as coin::wilcox_test) for all the subclass pairs test_rep_wilcoxon_r can
+    # compare, computed for all the features (rows of feats) at once
+    sparse = scipy.sparse.issparse(feats)
+    if sparse: feats = scipy.sparse.csc_matrix(feats)
+    else: feats = numpy.asarray(feats,dtype=float)
+    pvs = {}
+    for k1,k2 in wilcoxon_pairs(sl,cl_hie,min_c,comp_only_same_subcl):
+        n1,n2 = sl[k1][1]-sl[k1][0], sl[k2][1]-sl[k2][0]
+        n = float(n1+n2)
+        grp = numpy.array([0]*n1+[1]*n2)
+        pv = numpy.empty(feats.shape[0])
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+            for b in range(0,feats.shape[0],block):
+                if sparse: x = scipy.sparse.hstack((feats[b:b+block,sl[k1][0]:sl[k1][1]],feats[b:b+block,sl[k2][0]:sl[k2][1]]),format='csr')
+                else: x = numpy.concatenate((feats[b:b+block,sl[k1][0]:sl[k1][1]],feats[b:b+block,sl[k2][0]:sl[k2][1]]),axis=1)
+                rs,ties,cnt = _rank_sums(x,grp,2)
+                var = n1*n2*(n+1.0)/12.0 - n1*n2*ties/(12.0*n*(n-1.0))
+                z = (rs[:,0] - n1*(n+1.0)*0.5)/numpy.sqrt(var)
+                pv[b:b+block] = 2.0*scipy.stats.norm.sf(numpy.abs(z))
+        pvs[(k1,k2)] = pv
+    return pvs
+
+def _r_matrix(feats):
+    if scipy.sparse.issparse(feats): feats = feats.toarray()
+    feats = numpy.asarray(feats,dtype=float)
+    return robjects.r.matrix(robjects.FloatVector(feats.ravel().tolist()),nrow=feats.shape[0],byrow=True)
+
+def test_kw_rbatch(cls,feats,p,factors):
+    # batched equivalent of test_kw_r: the feature matrix is transferred to R
+    # once and kruskal.test is applied to all its rows in a single evaluation
+    init_r()
+    robjects.globalenv["X"] = _r_matrix(feats)
+    robjects.globalenv["x1"] = robjects.FactorVector(robjects.StrVector(cls[factors[0]]))
+    pv = numpy.array(list(robjects.r('apply(X,1,function(y) kruskal.test(y~x1)$p.value)')),dtype=float)
+    return pv < p, pv
+
+def test_wilcoxon_rbatch(sl,cl_hie,feats,min_c,comp_only_same_subcl):
+    # same as test_wilcoxon_native but with coin::wilcox_test evaluated in R,
+    # one call for all the features and subclass pairs
+    prs = wilcoxon_pairs(sl,cl_hie,min_c,comp_only_same_subcl)
+    if not prs: return {}
+    init_r(*coin_libs)
+    nf = feats.shape[0]
+    robjects.globalenv["X"] = _r_matrix(feats)
+    for v,ind in [("S1",0),("E1",1)]:
+        robjects.globalenv[v] = robjects.IntVector([sl[k1][ind] for k1,k2 in prs])
+    for v,ind in [("S2",0),("E2",1)]:
+        robjects.globalenv[v] = robjects.IntVector([sl[k2][ind] for k1,k2 in prs])
+    pv = numpy.array(list(robjects.r("""matrix(vapply(seq_along(S1),function(i) {
+            a <- (S1[i]+1):E1[i]
+            b <- (S2[i]+1):E2[i]
+            y <- factor(rep(c("a","b"),c(length(a),length(b))))
+            apply(X[,c(a,b),drop=FALSE],1,function(x) pvalue(wilcox_test(x~y,data=data.frame(x,y))))
+        },numeric(nrow(X))),nrow=nrow(X))""")),dtype=float)
+    return dict([(pr,pv[i*nf:(i+1)*nf]) for i,pr in enumerate(prs)])
+
+def test_rep_wilcoxon_r(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,comp_only_same_subcl,curv=False,pvs=None):
     comp_all_sub = not comp_only_same_subcl
     tot_ok =  0
     alpha_mtc = th
@@ -85,8 +529,11 @@ def test_rep_wilcoxon_r(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,com
                 sx,sy = numpy.median(cl1),numpy.median(cl2)
                 if cl1[0] == cl2[0] and len(set(cl1)) == 1 and  len(set(cl2)) == 1:
                     tres, first = False, False
+                elif not med_comp and pvs is not None:
+                    tres = pvs[(k1,k2)] < alpha_mtc*2.0
                 elif not med_comp:
-                    robjects.globalenv["x"] = robjects.FloatVector(cl1+cl2)
+                    init_r(*coin_libs)
+                    robjects.globalenv["x"] = robjects.FloatVector(list(cl1)+list(cl2))
                     robjects.globalenv["y"] = robjects.FactorVector(robjects.StrVector(["a" for a in cl1]+["b" for b in cl2]))
                     pv = float(robjects.r('pvalue(wilcox_test(x~y,data=data.frame(x,y)))')[0])
                     tres = pv < alpha_mtc*2.0
@@ -131,111 +578,201 @@ def test_rep_wilcoxon_r(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,com
 
 
 
-def contast_within_classes_or_few_per_class(feats,inds,min_cl,ncl):
-    ff = list(zip(*[v for n,v in feats.items() if n != 'class']))
-    cols = [ff[i] for i in inds]
-    cls = [feats['class'][i] for i in inds]
-    if len(set(cls)) < ncl:
+def contast_within_classes_or_few_per_class(x,cls,inds,min_cl,ncl):
+    # x is the samples x features matrix and cls the class index of each
+    # sample, both built once per run: True if the subsample inds misses a
+    # class, has too few samples in one, or has a feature with too few
+    # distinct values within a class
+    cls = cls[inds]
+    cnt = numpy.bincount(cls)
+    if (cnt > 0).sum() < ncl or (cnt[cnt > 0] < min_cl).any():
         return True
-    for c in set(cls):
-        if cls.count(c) < min_cl:
+    for c in numpy.flatnonzero(cnt):
+        col = numpy.sort(x[inds[cls == c]],axis=0)
+        if (1+(col[1:] != col[:-1]).sum(axis=0) <= max(min_cl,1)).any():
             return True
-        cols_cl = [x for i,x in enumerate(cols) if cls[i] == c]
-        for i,col in enumerate(zip(*cols_cl)):
-            if (len(set(col)) <= min_cl and min_cl > 1) or (min_cl == 1 and len(set(col)) <= 1):
-                return True
     return False
 
-def test_lda_r(cls,feats,cl_sl,boots,fract_sample,lda_th,tol_min,nlogs):
-    fk = list(feats.keys())
-    means = dict([(k,[]) for k in feats.keys()])
-    feats['class'] = list(cls['class'])
-    clss = list(set(feats['class']))
-
-    for uu,k in enumerate(fk):
-        if k == 'class':
-            continue
-
-        ff = [(feats['class'][i],v) for i,v in enumerate(feats[k])]
-
-        for c in clss:
-            if len(set([float(v[1]) for v in ff if v[0] == c])) > max(float(feats['class'].count(c))*0.5,4):
-                continue
-
-            for i,v in enumerate(feats[k]):
-                if feats['class'][i] == c:
-                    feats[k][i] = math.fabs(feats[k][i] + lrand.normalvariate(0.0,max(feats[k][i]*0.05,0.01)))
-
-    rdict = {}
-
-    for a,b in feats.items():
-        if a == 'class' or a == 'subclass' or a == 'subject':
-            rdict[a] = robjects.StrVector(b)
-        else:
-            rdict[a] = robjects.FloatVector(b)
-
-    robjects.globalenv["d"] = robjects.DataFrame(rdict)
-    lfk = len(feats[fk[0]])
-    rfk = int(float(len(feats[fk[0]]))*fract_sample)
+def lda_native(x,y,tol=1.0e-4):
+    # NumPy port of MASS::lda (method "moment") for the samples x features
+    # matrix x and the class labels y: returns the class levels, the class
+    # means and the scaling matrix (the LD1 coefficients are its first column)
+    lev,g = numpy.unique(y,return_inverse=True)
+    n,p = x.shape
+    ng = len(lev)
+    counts = numpy.bincount(g,minlength=ng).astype(float)
+    prior = counts/n
+    ind = numpy.zeros((n,ng))
+    ind[numpy.arange(n),g] = 1.0
+    means = numpy.dot(ind.T,x)/counts[:,None]
+    xc = x - means[g]
+    f1 = numpy.std(xc,axis=0,ddof=1)
+    if (f1 < tol).any():
+        raise ValueError("variable(s) "+" ".join([str(i+1) for i in numpy.flatnonzero(f1 < tol)])+" appear to be constant within groups")
+    xs = numpy.sqrt(1.0/(n-ng))*xc/f1
+    u,sv,vt = numpy.linalg.svd(xs,full_matrices=False)
+    rank = int((sv > tol).sum())
+    if rank == 0:
+        raise ValueError("rank = 0: variables are numerically constant")
+    scaling = (vt[:rank].T/sv[:rank])/f1[:,None]
+    xbar = numpy.dot(prior,means)
+    xs = numpy.sqrt(n*prior/(ng-1.0))[:,None]*numpy.dot(means-xbar,scaling)
+    u,sv,vt = numpy.linalg.svd(xs,full_matrices=False)
+    rank = int((sv > tol*sv[0]).sum())
+    if rank == 0:
+        raise ValueError("group means are numerically identical")
+    return lev,means,numpy.dot(scaling,vt[:rank].T)
+
+def init_lda_boot(feats,cls,pairs,engine,tol_min,fract_sample,min_cl,ncl):
+    # sets up the data shared by all the bootstrap iterations of test_lda_r
+    # (called once in each worker process when they are run in parallel, the
+    # workers start their own R session if needed)
+    global lda_boot_data
+    fk = feats.keys()
+    lfk = len(cls)
+    rfk = int(float(len(cls))*fract_sample)
     f = "class ~ "+fk[0]
 
     for k in fk[1:]:
         f += " + " + k.strip()
 
-    ncl = len(set(cls['class']))
-    min_cl = int(float(min([cls['class'].count(c) for c in set(cls['class'])]))*fract_sample*fract_sample*0.5)
-    min_cl = max(min_cl,1)
-    pairs = [(a,b) for a in set(cls['class']) for b in set(cls['class']) if a > b]
-
-    for k in fk:
-        for i in range(boots):
-            means[k].append([])
+    d = feats.data.T
+    d_cls = numpy.array(cls)
+    d_ci = numpy.unique(d_cls,return_inverse=True)[1]
+    if engine != 'native':
+        init_r('MASS')
+        rdict = {}
 
-    for i in range(boots):
-        for rtmp in range(1000):
-            rand_s = [lrand.randint(0,lfk-1) for v in range(rfk)]
-            if not contast_within_classes_or_few_per_class(feats,rand_s,min_cl,ncl):
-                break
-
-        rand_s = [r+1 for r in rand_s]
-        means[k][i] = []
-
-        for p in pairs:
-            robjects.globalenv["rand_s"] = robjects.IntVector(rand_s)
-            robjects.globalenv["sub_d"] = robjects.r('d[rand_s,]')
-            z = robjects.r('z <- suppressWarnings(lda(as.formula('+f+'),data=sub_d,tol='+str(tol_min)+'))')
-            robjects.r('w <- z$scaling[,1]')
-            robjects.r('w.unit <- w/sqrt(sum(w^2))')
-            robjects.r('ss <- sub_d[,-match("class",colnames(sub_d))]')
-
-            if 'subclass' in feats:
-                robjects.r('ss <- ss[,-match("subclass",colnames(ss))]')
-
-            if 'subject' in feats:
-                robjects.r('ss <- ss[,-match("subject",colnames(ss))]')
-
-            robjects.r('xy.matrix <- as.matrix(ss)')
-            robjects.r('LD <- xy.matrix%*%w.unit')
+        for a,b in feats.items():
+            rdict[a] = robjects.FloatVector(b)
+        rdict['class'] = robjects.StrVector(cls)
+
+        robjects.globalenv["d"] = robjects.DataFrame(rdict)
+
+    lda_boot_data = feats,fk,pairs,engine,tol_min,lfk,rfk,min_cl,ncl,f,d,d_cls,d_ci
+
+def init_lda_boot_shared(names,ref,*args):
+    init_lda_boot(FeatureMatrix(names,attach_matrix(ref)),*args)
+
+def lda_boot(seed):
+    # one bootstrap iteration of test_lda_r, the subsample is drawn from the
+    # random stream given by seed, returns the scores (pairs x features array)
+    feats,fk,pairs,engine,tol_min,lfk,rfk,min_cl,ncl,f,d,d_cls,d_ci = lda_boot_data
+    rng = numpy.random.default_rng(seed)
+    for rtmp in range(1000):
+        rand_s = rng.integers(0,lfk,rfk)
+        if not contast_within_classes_or_few_per_class(d,d_ci,rand_s,min_cl,ncl):
+            break
+
+    if engine == 'native':
+        sub_d,sub_cls = d[rand_s],d_cls[rand_s]
+        lev,mm,scaling = lda_native(sub_d,sub_cls,tol_min)
+        w_unit = scaling[:,0]/numpy.sqrt(numpy.sum(scaling[:,0]**2))
+        ld = numpy.dot(sub_d,w_unit)
+        cl_means = dict(zip(lev,mm))
+    else:
+        robjects.globalenv["rand_s"] = robjects.IntVector([int(r)+1 for r in rand_s])
+        robjects.globalenv["sub_d"] = robjects.r('d[rand_s,]')
+        z = robjects.r('z <- suppressWarnings(lda(as.formula('+f+'),data=sub_d,tol='+str(tol_min)+'))')
+        robjects.r('w <- z$scaling[,1]')
+        robjects.r('w.unit <- w/sqrt(sum(w^2))')
+        robjects.r('ss <- sub_d[,-match("class",colnames(sub_d))]')
+
+        if 'subclass' in feats:
+            robjects.r('ss <- ss[,-match("subclass",colnames(ss))]')
+
+        if 'subject' in feats:
+            robjects.r('ss <- ss[,-match("subject",colnames(ss))]')
+
+        robjects.r('xy.matrix <- as.matrix(ss)')
+        robjects.r('LD <- xy.matrix%*%w.unit')
+        rres = robjects.r('mm <- z$means')
+        cl_means = dict([(pp,numpy.array(rres.rx(pp,True),dtype=float)) for pp in rres.rownames])
+
+    scores = numpy.empty((len(pairs),len(fk)))
+    zeros = numpy.zeros(len(fk))
+    for i,p in enumerate(pairs):
+        if engine == 'native':
+            with numpy.errstate(invalid='ignore'):
+                effect_size = abs(numpy.mean(ld[sub_cls == p[0]]) - numpy.mean(ld[sub_cls == p[1]])) if (sub_cls == p[0]).any() and (sub_cls == p[1]).any() else float('nan')
+            coeff = numpy.nan_to_num(numpy.abs(w_unit*effect_size),nan=0.0)
+        else:
             robjects.r('effect.size <- abs(mean(LD[sub_d[,"class"]=="'+p[0]+'"]) - mean(LD[sub_d[,"class"]=="'+p[1]+'"]))')
             scal = robjects.r('wfinal <- w.unit * effect.size')
-            rres = robjects.r('mm <- z$means')
-            rowns = list(rres.rownames)
-            lenc = len(list(rres.colnames))
-            coeff = [abs(float(v)) if not math.isnan(float(v)) else 0.0 for v in scal]
-            res = dict([(pp,[float(ff) for ff in rres.rx(pp,True)] if pp in rowns else [0.0]*lenc ) for pp in [p[0],p[1]]])
+            coeff = numpy.nan_to_num(numpy.abs(numpy.array(scal,dtype=float)),nan=0.0)
+        scores[i] = (numpy.abs(cl_means.get(p[0],zeros) - cl_means.get(p[1],zeros))+coeff)*0.5
+
+    return scores
+
+def lda_boot_scores(cls,feats,boots,fract_sample,tol_min,engine='r',seed=1982,nproc=1,done=None,checkpoint=None):
+    # the LDA scores (bootstraps x class pairs x features) of test_lda_r, the
+    # scores of the first bootstraps can be given in done (they are not run
+    # again), checkpoint (if given) is called with the scores computed so far
+    # (a view on the preallocated result) after each bootstrap. The
+    # jitter is added to a private dense copy of feats (which can be sparse
+    # or a read-only memory map)
+    fk = feats.keys()
+    clss = sorted(set(cls['class']))
+    rnd = lrand.Random(seed)
+    cl_ind = [numpy.flatnonzero(numpy.array(cls['class']) == c) for c in clss]
+    feats = FeatureMatrix(fk,numpy.array(feats.dense().data,dtype=float))
 
-            for j,k in enumerate(fk):
-                gm = abs(res[p[0]][j] - res[p[1]][j])
-                means[k][i].append((gm+coeff[j])*0.5)
+    for k in fk:
+        v = feats[k]
 
-    res = {}
+        for ind in cl_ind:
+            if len(numpy.unique(v[ind])) > max(float(len(ind))*0.5,4):
+                continue
 
-    for k in fk:
-        m = max([numpy.mean([means[k][kk][p] for kk in range(boots)]) for p in range(len(pairs))])
-        res[k] = math.copysign(1.0,m)*math.log(1.0+math.fabs(m),10)
+            for i in ind:
+                v[i] = math.fabs(v[i] + rnd.normalvariate(0.0,max(v[i]*0.05,0.01)))
+
+    ncl = len(set(cls['class']))
+    min_cl = int(float(min([cls['class'].count(c) for c in set(cls['class'])]))*fract_sample*fract_sample*0.5)
+    min_cl = max(min_cl,1)
+    pairs = [(a,b) for a in clss for b in clss if a > b]
+
+    # every bootstrap has its own random stream spawned from the master seed,
+    # so the scores do not depend on the number of worker processes
+    seeds = numpy.random.SeedSequence(seed).spawn(boots)
+    args = (feats,list(cls['class']),pairs,engine,tol_min,fract_sample,min_cl,ncl)
+    scores = numpy.empty((boots,len(pairs),len(fk)))
+    n = 0 if done is None else min(len(done),boots)
+    if n: scores[:n] = done[:n]
+    if nproc > 1 and n < boots:
+        ref,blocks = share_matrix(feats.data)
+        try:
+            with multiprocessing.get_context('spawn').Pool(nproc,init_lda_boot_shared,(feats.names,ref)+args[1:]) as pool:
+                for sc in pool.imap(lda_boot,seeds[n:]):
+                    scores[n] = sc
+                    n += 1
+                    if checkpoint: checkpoint(scores[:n])
+        finally:
+            release_shared(blocks)
+    elif n < boots:
+        init_lda_boot(*args)
+        for sd in seeds[n:]:
+            scores[n] = lda_boot(sd)
+            n += 1
+            if checkpoint: checkpoint(scores[:n])
+    return scores
+
+def lda_boot_sd(fk,scores):
+    # standard deviation over the bootstrap iterations of the LDA scores
+    m = numpy.asarray(scores).max(axis=1)
+    ld = numpy.sign(m)*numpy.log10(1.0+numpy.abs(m))
+    return dict(zip(fk,ld.std(axis=0).tolist()))
+
+def lda_effect_sizes(fk,scores,lda_th):
+    m = numpy.mean(scores,axis=0).max(axis=0)
+    res = dict([(k,math.copysign(1.0,m[j])*math.log(1.0+math.fabs(m[j]),10)) for j,k in enumerate(fk)])
 
     return res,dict([(k,x) for k,x in res.items() if math.fabs(x) > lda_th])
 
+def test_lda_r(cls,feats,cl_sl,boots,fract_sample,lda_th,tol_min,nlogs,engine='r',seed=1982,nproc=1):
+    scores = lda_boot_scores(cls,feats,boots,fract_sample,tol_min,engine,seed,nproc)
+    return lda_effect_sizes(feats.keys(),scores,lda_th)
+
 
 def test_svm(cls,feats,cl_sl,boots,fract_sample,lda_th,tol_min,nsvm):
     return None
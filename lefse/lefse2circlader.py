@@ -3,6 +3,7 @@
 import sys
 import os
 import argparse
+from lefse.lefse import res_rows
 
 def read_params(args):
     parser = argparse.ArgumentParser(description='Convert LEfSe output to '
@@ -21,8 +22,8 @@ def lefse2circlader():
     par = read_params(sys.argv)
     finp,fout = bool(par['inp_f']), bool(par['out_f'])
 
-    with open(par['inp_f']) if finp else sys.stdin as inpf:
-        put_bm = (l.strip().split('\t') for l in inpf.readlines()) 
+    if finp: put_bm = res_rows(par['inp_f'])
+    else: put_bm = (l.strip().split('\t') for l in sys.stdin.readlines())
     biomarkers = [p for p in put_bm if len(p) > 2]
 
     circ = [    [   b[0],
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 
 import sys,os,argparse,pickle,re,numpy
+import scipy.sparse
 
-import functools
 from lefsebiom.ConstantsBreadCrumbs import *
 from lefsebiom.AbundanceTable import *
+from lefse.lefse import save_data,FeatureMatrix
+from lefse.compressed import open_compressed,uncompressed_name
 
 #***************************************************************************************************************
 #*   Log of change                                                                                             *
@@ -45,15 +47,88 @@ from lefsebiom.AbundanceTable import *
 #*                                                                                                             *
 #***************************************************************************************************************
 
-def read_input_file(inp_file, CommonArea):
+def read_input_file(inp_file, CommonArea, feats_dir = "r", meta_ind = (), chunk = 1024, sparse = False):
 
-    if inp_file.endswith('.biom'):              #*  If the file format is biom:
-        CommonArea = biom_processing(inp_file)  #*  Process in biom format
+    if uncompressed_name(inp_file).endswith('.biom'):   #*  If the file format is biom:
+        CommonArea = biom_processing(inp_file, sparse)  #*  Process in biom format
         return CommonArea                       #*  And return the CommonArea
 
-    with open(inp_file) as inp:
-        CommonArea['ReturnedData'] = [[v.strip() for v in line.strip().split("\t")] for line in inp.readlines()]
+    #*  The table is streamed twice: the first pass only counts the lines   *
+    #*  (and columns), the second one parses the numeric values in chunks   *
+    #*  directly into the preallocated feature matrix, only the metadata    *
+    #*  (rows or columns with index in meta_ind) is kept as strings.        *
+    #*  Compressed (gz, bz2, xz) files are decompressed on the fly.         *
+    #*  With sparse each chunk is converted to CSR and the chunks are       *
+    #*  stacked at the end, so the dense matrix is never allocated.         *
+    with open_compressed(inp_file) as inp:
+        header = [v.strip() for v in inp.readline().strip().split("\t")]
+        nlines = 1 + sum(1 for line in inp if line.strip())
+
+    meta = {}
+    if feats_dir == "c":
+        meta_ind = [i for i in meta_ind if i < len(header)]
+        fcols = [i for i in range(len(header)) if i not in meta_ind]
+        names = [header[i] for i in fcols]
+        abundances = [] if sparse else numpy.empty((len(fcols),nlines-1))
+        for i in meta_ind: meta[i] = []
+        with open_compressed(inp_file) as inp:
+            inp.readline()
+            j = 0
+            for rows in read_chunks(inp,chunk):
+                for i in meta_ind: meta[i].extend([r[i] for r in rows])
+                vals = numpy.array([[r[i] for i in fcols] for r in rows],dtype=float).T
+                if sparse: abundances.append(scipy.sparse.csr_matrix(vals))
+                else: abundances[:,j:j+len(rows)] = vals
+                j += len(rows)
+        if sparse: abundances = scipy.sparse.hstack(abundances,format='csr') if abundances else scipy.sparse.csr_matrix((len(fcols),0))
+    else:
+        meta_ind = [i for i in meta_ind if i < nlines]
+        names = []
+        abundances = [] if sparse else numpy.empty((nlines-len(meta_ind),len(header)-1))
+        with open_compressed(inp_file) as inp:
+            i,j = 0,0
+            for rows in read_chunks(inp,chunk):
+                vals = []
+                for r in rows:
+                    if i in meta_ind: meta[i] = r[1:]
+                    else:
+                        names.append(r[0])
+                        vals.append(r[1:])
+                    i += 1
+                if vals and sparse: abundances.append(scipy.sparse.csr_matrix(numpy.array(vals,dtype=float)))
+                elif vals: abundances[j:j+len(vals)] = numpy.array(vals,dtype=float)
+                j += len(vals)
+        if sparse: abundances = scipy.sparse.vstack(abundances,format='csr') if abundances else scipy.sparse.csr_matrix((0,len(header)-1))
+
+    CommonArea['FeatureNames'] = names
+    CommonArea['Metadata'] = meta
+    CommonArea['Abundances'] = abundances
+    return CommonArea
+
+def read_chunks(inp, chunk):
+    rows = []
+    for line in inp:
+        if not line.strip(): continue
+        rows.append([v.strip() for v in line.strip().split("\t")])
+        if len(rows) == chunk:
+            yield rows
+            rows = []
+    if rows: yield rows
+
+def split_metadata(data, CommonArea, meta_ind, sparse = False, chunk = 1024):
+    if 'BiomAbundances' in CommonArea:      #*  sparse biom: data holds only the metadata rows
+        CommonArea['FeatureNames'] = CommonArea['BiomFeatureNames']
+        CommonArea['Metadata'] = dict([(i,list(data[i][1:])) for i in meta_ind])
+        CommonArea['Abundances'] = CommonArea['BiomAbundances']
         return CommonArea
+    CommonArea['FeatureNames'] = [d[0] for i,d in enumerate(data) if i not in meta_ind]
+    CommonArea['Metadata'] = dict([(i,list(data[i][1:])) for i in meta_ind])
+    rows = [d[1:] for i,d in enumerate(data) if i not in meta_ind]
+    if sparse:
+        CommonArea['Abundances'] = scipy.sparse.vstack([scipy.sparse.csr_matrix(numpy.array(rows[i:i+chunk],dtype=float))
+                                                        for i in range(0,len(rows),chunk)],format='csr')
+    else: CommonArea['Abundances'] = numpy.array(rows,dtype=float)
+    return CommonArea
 
 def transpose(data):
     return list(zip(*data))
@@ -62,7 +137,7 @@ def read_params(args):
     parser = argparse.ArgumentParser(description='LEfSe formatting modules')
     parser.add_argument('input_file', metavar='INPUT_FILE', type=str, help="the input file, feature hierarchical level can be specified with | or . and those symbols must not be present for other reasons in the input file.")
     parser.add_argument('output_file', metavar='OUTPUT_FILE', type=str,
-        help="the output file containing the data for LEfSe")
+        help="the output file containing the data for LEfSe (compressed if its name ends with .gz, .bz2 or .xz)")
     parser.add_argument('--output_table', type=str, required=False, default="",
         help="the formatted table in txt format")
     parser.add_argument('-f',dest="feats_dir", choices=["c","r"], type=str, default="r",
@@ -80,12 +155,28 @@ def read_params(args):
     parser.add_argument('-n',dest="subcl_min_card", metavar="int", type=int, default=10,
         help="set the minimum cardinality of each subclass (subclasses with low cardinalities will be grouped together, if the cardinality is still low, no pairwise comparison will be performed with them)")
 
+    parser.add_argument('--output_format',dest="output_format", choices=["bin","pickle"], type=str, default="bin",
+        help="set the format of the output file: bin (binary, memory-mappable by lefse_run.py, default) or pickle (the format of the previous versions)")
+    parser.add_argument('--sparse',dest="sparse", choices=[0,1], type=int, default=0,
+        help="keep the abundances in a sparse matrix (recommended for tables with mostly zeros such as OTU/ASV tables, default 0)")
+
+    parser.add_argument('--min_abundance',dest="min_abundance", metavar="float", type=float, default=0.0,
+        help="keep a feature only if it reaches this abundance (after the normalization) in at least --min_samples samples (default 0.0 meaning no filtering)")
+    parser.add_argument('--min_samples',dest="min_samples", metavar="int", type=int, default=1,
+        help="the minimum number of samples in which a feature must reach --min_abundance (default 1)")
+    parser.add_argument('--min_prevalence',dest="min_prevalence", metavar="float", type=float, default=0.0,
+        help="remove the features present (non-zero) in less than this fraction of the samples (default 0.0 meaning no filtering)")
+    parser.add_argument('--min_sd',dest="min_sd", metavar="float", type=float, default=0.0,
+        help="remove the features with standard deviation (after the normalization) lower than this value (default 0.0 meaning no filtering)")
+
     parser.add_argument('-biom_c',dest="biom_class", type=str,
         help="For biom input files: Set which feature use as class  ")
     parser.add_argument('-biom_s',dest="biom_subclass", type=str,
         help="For biom input files: set which feature use as subclass   ")
 
     args = parser.parse_args()
+    if args.min_abundance > 0.0 and args.min_samples < 1:
+        parser.error("--min_samples must be at least 1 when --min_abundance is set")
 
     return vars(args)
 
@@ -102,44 +193,12 @@ def remove_missing(data,roc):
     return data
 
 
-def sort_by_cl(data,n,c,s,u):
-    def sort_lines1(a,b):
-        return int(a[c] > b[c])*2-1
-
-    def sort_lines2u(a,b):
-        if a[c] != b[c]:
-            return int(a[c] > b[c])*2-1
-
-        return int(a[u] > b[u])*2-1
-
-    def sort_lines2s(a,b):
-        if a[c] != b[c]:
-            return int(a[c] > b[c])*2-1
-
-        return int(a[s] > b[s])*2-1
-
-    def sort_lines3(a,b):
-        if a[c] != b[c]:
-            return int(a[c] > b[c])*2-1
-
-        if a[s] != b[s]:
-            return int(a[s] > b[s])*2-1
-
-        return int(a[u] > b[u])*2-1
-
-    if n == 3:
-        data.sort(key = functools.cmp_to_key(lambda a,b: sort_lines3(a,b)))
-
-    if n == 2:
-        if s is None:
-            data.sort(key = functools.cmp_to_key(lambda a,b: sort_lines2u(a,b)))
-        else:
-            data.sort(key = functools.cmp_to_key(lambda a,b: sort_lines2s(a,b)))
-
-    if n == 1:
-        data.sort(key = functools.cmp_to_key(lambda a,b: sort_lines1(a,b)))
-
-    return data
+def sort_by_cl(meta,n,c,s,u):
+    #*  meta holds the metadata rows (one value per sample): the returned    *
+    #*  permutation of the samples orders them by class, then by subclass    *
+    #*  and/or subject (ties keep the order of the input file)               *
+    keys = list(zip(*[meta[k] for k in (c,s,u) if k is not None][:n]))
+    return sorted(range(len(keys)),key = keys.__getitem__)
 
 def group_small_subclasses(cls,min_subcl):
     last = ""
@@ -186,30 +245,76 @@ def get_class_slices(data):
     class_hierarchy.append((previous_class,subcls))
     return dict(class_slices), dict(subclass_slices), dict(class_hierarchy)
 
-def numerical_values(feats,norm):
-    mm = []
-    for k,v in feats.items():
-        feats[k] = [float(val) for val in v]
-    if norm < 0.0: return feats
-    tr = list(zip(*(list(feats.values()))))
-    mul = []
-    fk = list(feats.keys())
-    hie = True if sum([k.count(".") for k in fk]) > len(fk) else False
-    for i in range(len(list(feats.values())[0])):
-        if hie: mul.append(sum([t for j,t in enumerate(tr[i]) if fk[j].count(".") < 1 ]))
-        else: mul.append(sum(tr[i]))
+def numerical_values(names,x,norm):
+    #*  x is the features x samples matrix (dense or CSR, freshly built by   *
+    #*  the caller so it is scaled in place), the samples are scaled to sum  *
+    #*  to norm over the root level features (or over all the features if   *
+    #*  the names have no hierarchy) and the near-constant features are      *
+    #*  rounded to 6 decimals, all as whole-matrix operations                *
+    sparse = scipy.sparse.issparse(x)
+    if norm < 0.0: return x
+    hie = True if sum([k.count(".") for k in names]) > len(names) else False
+    if hie: mul = numpy.asarray(x[[j for j,k in enumerate(names) if k.count(".") < 1]].sum(axis=0),dtype=float).ravel()
+    else: mul = numpy.asarray(x.sum(axis=0),dtype=float).ravel()
     if hie and sum(mul) == 0:
-        mul = []
-        for i in range(len(list(feats.values())[0])):
-            mul.append(sum(tr[i])) 
-    for i,m in enumerate(mul):
-        if m == 0: mul[i] = 0.0
-        else: mul[i] = float(norm) / m
-    for k,v in feats.items():
-        feats[k] = [val*mul[i] for i,val in enumerate(v)]
-        if numpy.mean(feats[k]) and (numpy.std(feats[k])/numpy.mean(feats[k])) < 1e-10:
-            feats[k] = [ float(round(kv*1e6)/1e6) for kv in feats[k]]
-    return feats
+        mul = numpy.asarray(x.sum(axis=0),dtype=float).ravel()
+    with numpy.errstate(divide='ignore'):
+        mul = numpy.where(mul == 0,0.0,float(norm)/mul)
+    if sparse:
+        x.data *= mul[x.indices]
+        # a row with a zero can only be near-constant (as the test below is
+        # written) if it has a negative value, making the mean negative, so
+        # only the rows without zeros or with negative values are checked
+        neg = numpy.bincount(numpy.repeat(numpy.arange(x.shape[0]),numpy.diff(x.indptr))[x.data < 0],minlength=x.shape[0])
+        rows = numpy.flatnonzero((numpy.diff(x.indptr) == x.shape[1]) | (neg > 0))
+        v = x[rows].toarray()
+    else:
+        x *= mul
+        rows,v = numpy.arange(x.shape[0]),x
+    m = v.mean(axis=1)
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        low = (m != 0) & (v.std(axis=1)/m < 1e-10)
+    if sparse:
+        sel = numpy.zeros(x.shape[0],dtype=bool)
+        sel[rows[low]] = True
+        sel = numpy.repeat(sel,numpy.diff(x.indptr))
+        x.data[sel] = numpy.round(x.data[sel]*1e6)/1e6
+    else: x[low] = numpy.round(x[low]*1e6)/1e6
+    return x
+
+def row_counts(x,sel):
+    #*  number of entries of each row of x (dense or CSR) satisfying sel,    *
+    #*  the implicit zeros of a CSR matrix are counted if sel(0) holds       *
+    if not scipy.sparse.issparse(x): return sel(x).sum(axis=1)
+    cnt = numpy.bincount(numpy.repeat(numpy.arange(x.shape[0]),numpy.diff(x.indptr))[sel(x.data)],minlength=x.shape[0])
+    if sel(numpy.zeros(1))[0]: cnt += x.shape[1]-numpy.diff(x.indptr)
+    return cnt
+
+def row_sd(x):
+    if not scipy.sparse.issparse(x): return x.std(axis=1)
+    m = numpy.asarray(x.mean(axis=1)).ravel()
+    return numpy.sqrt(numpy.maximum(numpy.asarray(x.multiply(x).mean(axis=1)).ravel()-m*m,0.0))
+
+def prefilter_features(names,x,params):
+    #*  the features failing one of the prefilters (minimum abundance in    *
+    #*  a number of samples, minimum prevalence and minimum standard        *
+    #*  deviation, in this order) are removed, each filter being a single   *
+    #*  whole-matrix operation; the removed features are reported per filter*
+    filters = []
+    if params['min_abundance'] > 0.0:
+        filters.append( ("abundance >= "+str(params['min_abundance'])+" in "+str(params['min_samples'])+" samples",
+                         lambda x: row_counts(x,lambda v: v >= params['min_abundance']) >= params['min_samples']) )
+    if params['min_prevalence'] > 0.0:
+        filters.append( ("prevalence >= "+str(params['min_prevalence']),
+                         lambda x: row_counts(x,lambda v: v != 0) >= params['min_prevalence']*x.shape[1]) )
+    if params['min_sd'] > 0.0:
+        filters.append( ("standard deviation >= "+str(params['min_sd']),
+                         lambda x: row_sd(x) >= params['min_sd']) )
+    for desc,keep in filters:
+        keep = numpy.flatnonzero(keep(x))
+        print("Prefilter",desc+":",len(names)-len(keep),"features removed")
+        if len(keep) < len(names): names,x = [names[i] for i in keep],x[keep]
+    return names,x
 
 def add_missing_levels2(ff):
 
@@ -241,47 +346,47 @@ def add_missing_levels2(ff):
     return ff
 
 
-def add_missing_levels(ff):
-    if sum( [f.count(".") for f in ff] ) < 1: return ff
+def add_missing_levels(names,x):
+    #*  the missing internal clades are appended (as rows of x, dense or CSR) *
+    #*  with the sum of the rows of all the features below them: the clade    *
+    #*  membership is built once as an indicator matrix (missing clades x     *
+    #*  features), so all the sums are a single sparse matrix product         *
+    if sum( [f.count(".") for f in names] ) < 1: return names,x
 
-    clades2leaves = {}
-    for f in ff:
+    index = set(names)
+    clades = {}
+    rows,cols = [],[]
+    for j,f in enumerate(names):
         fs = f.split(".")
-        if len(fs) < 2:
-            continue
-        for l in range(len(fs)):
+        for l in range(1,len(fs)):
             n = ".".join( fs[:l] )
-            if n in clades2leaves:
-                clades2leaves[n].append( f )
-            else:
-                clades2leaves[n] = [f]
-    for k,v in clades2leaves.items():
-        if k and k not in ff:
-            ff[k] = [sum(a) for a in zip(*[[float(fn) for fn in ff[vv]] for vv in v])]
-    return ff
-
-
-def modify_feature_names(fn):
-    ret = fn
-
-    for v in [' ',r'\$',r'\@',r'#',r'%',r'\^',r'\&',r'\*',r'\"',r'\'']:
-        ret = [re.sub(v,"",f) for f in ret]
+            if n in index: continue
+            rows.append( clades.setdefault(n,len(clades)) )
+            cols.append( j )
+    if not clades: return names,x
+    ind = scipy.sparse.csr_matrix((numpy.ones(len(cols)),(rows,cols)),shape=(len(clades),len(names)))
+    if scipy.sparse.issparse(x): x = scipy.sparse.vstack([x,ind.dot(x).sorted_indices()],format='csr')
+    else: x = numpy.vstack([x,ind.dot(x)])
+    return list(names)+list(clades.keys()),x
 
-    for v in ["/",r'\(',r'\)',r'-',r'\+',r'=',r'{',r'}',r'\[',r'\]',
-              r',',r'\.',r';',r':',r'\?',r'\<',r'\>',r'\.',r'\,']:
-        ret = [re.sub(v,"_",f) for f in ret]
 
-    for v in ["\|"]:
-        ret = [re.sub(v,".",f) for f in ret]
+feature_name_table = str.maketrans(dict( [(c,"_") for c in "/()-+={}[],.;:?<>"] + [("|",".")] +
+                                          [(c,None) for c in ' $@#%^&*"\''] ))
 
-    ret2 = []
-    for r in ret:
-        if r[0] in ['0','1','2','3','4','5','6','7','8','9','_']:
-            ret2.append("f_"+r)
-        else:
-            ret2.append(r)
+def modify_feature_names(fn):
+    #*  one translate pass per name: the characters of feature_name_table   *
+    #*  are removed or replaced by "_" ("|", the clade separator, by "."),  *
+    #*  names starting with a digit or "_" are prefixed by "f_"             *
+    ret = [f.translate(feature_name_table) for f in fn]
+    return ["f_"+r if r.startswith(tuple("0123456789_")) else r for r in ret]
 
-    return ret2
+def feature_name_collisions(fn,names):
+    #*  the distinct input names that the sanitization maps to the same     *
+    #*  feature name, as a dict feature name -> list of input names        *
+    orig = {}
+    for f,n in zip(fn,names):
+        if f not in orig.setdefault(n,[]): orig[n].append(f)
+    return dict((n,o) for n,o in orig.items() if len(o) > 1)
 
 
 def rename_same_subcl(cl,subcl):
@@ -308,8 +413,22 @@ def rename_same_subcl(cl,subcl):
 #*  breadcrumbs src directory must be included in the PYTHONPATH                     *
 #*  <<<-------------  I M P O R T A N T     N O T E ------------------->>            *
 #*************************************************************************************
-def biom_processing(inp_file):
+def biom_processing(inp_file, sparse = False):
     CommonArea = dict()         #* Set up a dictionary to return
+    if sparse:
+        #****************************************************************
+        #*  The observations x samples matrix is taken as CSR straight  *
+        #*  from the biom table (no structured array, no lists)         *
+        #****************************************************************
+        BiomTable = AbundanceTable.funcReadBiomTable(inp_file)
+        Metadata = AbundanceTable.funcGetBiomSampleMetadata(BiomTable)
+        IDMetadataName = ConstantsBreadCrumbs.c_ID
+        CommonArea['BiomMetadata'] = Metadata
+        CommonArea['BiomFeatureNames'] = [str(o) for o in BiomTable.ids(axis='observation')]
+        CommonArea['BiomAbundances'] = scipy.sparse.csr_matrix(BiomTable.matrix_data,dtype=float)
+        CommonArea['ReturnedData'] = [[IDMetadataName]+Metadata[IDMetadataName]] + [[key]+value for key,value in Metadata.items() if key != IDMetadataName]
+        return CommonArea
+
     CommonArea['abndData']   = AbundanceTable.funcMakeFromFile(inp_file,    #* Create AbundanceTable from input biom file
         cDelimiter = None,
         sMetadataID = None,
@@ -326,7 +445,8 @@ def biom_processing(inp_file):
     IDMetadata.extend([IDMetadataEntry for IDMetadataEntry in CommonArea['abndData'].funcGetMetadataCopy()[IDMetadataName]]) #* Loop on all the metadata values
 
     ResolvedData.append(IDMetadata)                 #Add the IDMetadata with all its values to the resolved area
-    for key, value in  CommonArea['abndData'].funcGetMetadataCopy().items():
+    CommonArea['BiomMetadata'] = CommonArea['abndData'].funcGetMetadataCopy()
+    for key, value in  CommonArea['BiomMetadata'].items():
         if  key  != IDMetadataName:
             MetadataEntry = [key] + value     #*  Set it up
             ResolvedData.append(MetadataEntry)
@@ -347,7 +467,7 @@ def  check_params_for_biom_case(params, CommonArea):
     params['original_subject'] = params['subject']  #Save the original subclass
 
 
-    TotalMetadataEntriesAndIDInBiomFile = len(CommonArea['abndData'].funcGetMetadataCopy())  # The number of metadata entries
+    TotalMetadataEntriesAndIDInBiomFile = len(CommonArea['BiomMetadata'])  # The number of metadata entries
     for i in range(0,TotalMetadataEntriesAndIDInBiomFile):  #* Populate the meta data names table
         CommonArea['MetadataNames'].append(CommonArea['ReturnedData'][i][0])    #Add the metadata name
 
@@ -390,45 +510,36 @@ def format_input():
         params['subject'] = None
 
 
-    CommonArea = read_input_file(sys.argv[1], CommonArea)       #Pass The CommonArea to the Read
-    data = CommonArea['ReturnedData']                   #Select the data
+    meta_ind = [params[k]-1 for k in ['class','subclass','subject'] if params[k] is not None]
+    CommonArea = read_input_file(sys.argv[1], CommonArea, params['feats_dir'], meta_ind, sparse = params['sparse'])       #Pass The CommonArea to the Read
 
-    if sys.argv[1].endswith('biom'):    #*  Check if biom:
+    if uncompressed_name(sys.argv[1]).endswith('biom'):    #*  Check if biom:
         params = check_params_for_biom_case(params, CommonArea) #Check the params for the biom case
-
-    if params['feats_dir'] == "c":
-        data = transpose(data)
+        meta_ind = [params[k]-1 for k in ['class','subclass','subject'] if params[k] is not None]
+        CommonArea = split_metadata(CommonArea['ReturnedData'], CommonArea, meta_ind, params['sparse'])
 
     ncl = 1
     if not params['subclass'] is None: ncl += 1
     if not params['subject'] is None: ncl += 1
 
-    first_line = list(zip(*data))[0]
+    names = modify_feature_names(CommonArea['FeatureNames'])
+    meta = CommonArea['Metadata']
 
-    first_line = modify_feature_names(list(first_line))
-
-    data = list(zip( first_line,
-            *sort_by_cl(list(zip(*data))[1:],
+    #*  Samples are sorted on their metadata only, the resulting order is   *
+    #*  then applied to the metadata and (with one gather) to the matrix    *
+    perm = sort_by_cl([meta[i] for i in meta_ind],
               ncl,
-              params['class']-1,
-              params['subclass']-1 if not params['subclass'] is None else None,
-              params['subject']-1 if not params['subject'] is None else None)))
-#   data.insert(0,first_line)
+              0,
+              1 if not params['subclass'] is None else None,
+              ncl-1 if not params['subject'] is None else None)
+    abundances = CommonArea['Abundances'][:,perm]
 #   data = remove_missing(data,params['missing_p'])
     cls = {}
 
-    cls_i = [('class',params['class']-1)]
-    if params['subclass'] is not None and params['subclass'] > 0:
-        cls_i.append(('subclass',params['subclass']-1))
-
-    if params['subject'] is not None and params['subject'] > 0:
-        cls_i.append(('subject',params['subject']-1))
+    for k in ['class','subclass','subject']:
+        if params[k] is not None and params[k] > 0:
+            cls[k] = [meta[params[k]-1][j] for j in perm]
 
-    cls_i.sort(key = functools.cmp_to_key(lambda x,y: -((x[1] > y[1]) - (x[1] < y[1]))))
-
-    for v in cls_i: 
-        cls[v[0]] = data.pop(v[1])[1:]
-    
     if params['subclass'] is None:
         cls['subclass'] = [str(cl)+"_subcl" for cl in cls['class']]
 
@@ -442,13 +553,19 @@ def format_input():
     elif ('subclass' not in cls.keys()) and ('subject' in cls.keys()):
         class_sl, subclass_sl, class_hierarchy = get_class_slices(list(zip(cls['class'], cls['subject'])))
 
-    feats = dict([(d[0],d[1:]) for d in data])
+    #*  duplicated names keep the values of their last row (as the dict of   *
+    #*  the previous versions did) at the position of the first one         *
+    for n,o in feature_name_collisions(CommonArea['FeatureNames'],names).items():
+        print("Warning: the features",", ".join(o),"are all renamed to",n,"- only the last one is kept")
+    ind = dict(zip(names,range(len(names))))
+    if len(ind) < len(names): names,abundances = list(ind.keys()),abundances[list(ind.values())]
 
-    feats = add_missing_levels(feats)
+    names,abundances = add_missing_levels(names,abundances)
 
-    feats = numerical_values(feats,params['norm_v'])
+    abundances = numerical_values(names,abundances,params['norm_v'])
+    names,abundances = prefilter_features(names,abundances,params)
     out = {}
-    out['feats'] = feats
+    out['feats'] = FeatureMatrix(names,abundances)
     out['norm'] = params['norm_v']
     out['cls'] = cls
     out['class_sl'] = class_sl
@@ -456,14 +573,18 @@ def format_input():
     out['class_hierarchy'] = class_hierarchy
 
     if params['output_table']:
-        with open( params['output_table'], "w") as outf:
+        with open_compressed( params['output_table'], "wt") as outf:
             if 'class' in cls: outf.write( "\t".join(list(["class"])+list(cls['class'])) + "\n" )
             if 'subclass' in cls: outf.write( "\t".join(list(["subclass"])+list(cls['subclass'])) + "\n" )
             if 'subject' in cls: outf.write( "\t".join(list(["subject"])+list(cls['subject']))  + "\n" )
-            for k,v in out['feats'].items(): outf.write( "\t".join([k]+[str(vv) for vv in v]) + "\n" )
-
-    with open(params['output_file'], 'wb') as back_file:
-        pickle.dump(out,back_file)
+            for k,v in out['feats'].items(): outf.write( "\t".join([k]+[str(vv) for vv in v.tolist()]) + "\n" )
+
+    if params['output_format'] == 'bin':
+        save_data(out,params['output_file'])
+    else:
+        out['feats'] = dict([(k,v.tolist()) for k,v in out['feats'].items()])
+        with open_compressed(params['output_file'], 'wb') as back_file:
+            pickle.dump(out,back_file)
 
 
 if  __name__ == '__main__':
@@ -98,10 +98,9 @@ def get_all_nodes(father):
     return ret
 
 def read_data(input_file,params):
-    with open(input_file, 'r') as inp:
-        if params['sub_clade'] == "": 
-            rows = [line.strip().split()[:-1] for line in inp.readlines() if params['max_lev'] < 1 or line.split()[0].count(".") < params['max_lev']]
-        else: rows = [line.split(params['sub_clade']+".")[1].strip().split()[:-1] for line in inp.readlines() if ( params['max_lev'] < 1 or line.split()[0].count(".") < params['max_lev'] ) and line.startswith(params['sub_clade']+".")]
+    rows = [r[:4] if r[2] else r[:2] for r in res_rows(input_file) if params['max_lev'] < 1 or r[0].count(".") < params['max_lev']]
+    if params['sub_clade'] != "":
+        rows = [[r[0][len(params['sub_clade'])+1:]]+r[1:] for r in rows if r[0].startswith(params['sub_clade']+".")]
     all_names = [lin[0] for lin in rows]
     to_add = []
 
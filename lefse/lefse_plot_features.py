@@ -37,14 +37,13 @@ def read_params(args):
 	return vars(args)
 	
 def read_data(file_data,file_feats,params):
-	with open(file_feats, 'r') as features:
-		feats_to_plot = [(f.split()[:-1],len(f.split()) == 5) for f in features.readlines()]
+	feats_to_plot = [(r[:4] if r[2] else r[:2],bool(r[2])) for r in res_rows(file_feats)]
 	if not feats_to_plot:
 		print("No features to plot\n")
 		sys.exit(0)
 	feats,cls,class_sl,subclass_sl,class_hierarchy,params['norm_v'] = load_data(file_data, True)	 	
 	if params['feature_num'] > 0: 
-		params['feature_name'] = [line.split()[0] for line in open(params['input_file_2'])][params['feature_num']-1]
+		params['feature_name'] = [r[0] for r in res_rows(params['input_file_2'])][params['feature_num']-1]
 	features = {}
 	for f in feats_to_plot:
 		if params['f'] == "diff" and not f[1]: continue
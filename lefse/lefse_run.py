@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 
-import os,sys,math,pickle
+import os,sys,math,pickle,multiprocessing,time
 from lefse.lefse import *
 
 def read_params(args):
     parser = argparse.ArgumentParser(description='LEfSe 1.1.01')
     parser.add_argument('input_file', metavar='INPUT_FILE', type=str, help="the input file")
     parser.add_argument('output_file', metavar='OUTPUT_FILE', type=str,
-                help="the output file containing the data for the visualization module")
+                help="the output file containing the data for the visualization module (compressed if its name ends with .gz, .bz2 or .xz)")
+    parser.add_argument('--output_bin',dest="output_bin", metavar='str', type=str, default="",
+                help="also write the results (with the full class means, the KW p-values, the Wilcoxon outcomes and the LDA score spread) to this file in the typed binary format read by the plotting modules (default none)")
     parser.add_argument('-o',dest="out_text_file", metavar='str', type=str, default="",
                 help="set the file for exporting the result (only concise textual form)")
     parser.add_argument('-a',dest="anova_alpha", metavar='float', type=float, default=0.05,
@@ -44,6 +46,24 @@ def read_params(args):
                 help="set the title of the analysis (default input file without extension)")
     parser.add_argument('-y',dest="multiclass_strat", choices=[0,1], type=int, default=0,
                 help="(for multiclass tasks) set whether the test is performed in a one-against-one ( 1 - more strict!) or in a one-against-all setting ( 0 - less strict) (default 0)")
+    parser.add_argument('--nproc',dest="nproc", metavar='int', type=int, default=1,
+                help="number of worker processes for the KW and Wilcoxon tests and for the LDA bootstrap iterations (default 1)")
+    parser.add_argument('--seed',dest="seed", metavar='int', type=int, default=1982,
+                help="set the master seed of the random streams of the bootstrap iterations (default 1982)")
+    parser.add_argument('--engine',dest="engine", choices=["r","rbatch","native"], type=str, default="r",
+                help="set the implementation of the statistical tests: r (through rpy2, one call per feature, default), rbatch (through rpy2, the feature matrix is tested in R with a single call per step) or native (batched NumPy/SciPy)")
+    parser.add_argument('--cache_dir',dest="cache_dir", metavar='str', type=str, default="",
+                help="directory of the cache of the results, reused for runs with the same input file content and the same parameters (default no cache)")
+    parser.add_argument('--cache_max_size',dest="cache_max_size", metavar='float', type=float, default=1024.0,
+                help="maximum size of the cache in MB, the least recently used results are evicted above it (default 1024)")
+    parser.add_argument('--cache_max_age',dest="cache_max_age", metavar='float', type=float, default=30.0,
+                help="number of days after which a cached result expires (default 30)")
+    parser.add_argument('--stages',dest="stages", metavar='str', type=str, default="",
+                help="file keeping the KW p-values, the Wilcoxon outcomes and the LDA bootstrap scores of the run, the stages whose parameters did not change are reused from it by the next runs on the same input (default none)")
+    parser.add_argument('--checkpoint',dest="checkpoint", metavar='float', type=float, default=0.0,
+                help="save the tests and the LDA bootstrap iterations completed so far to OUTPUT_FILE.ckpt every given number of seconds (default 0 meaning no checkpoints)")
+    parser.add_argument('--resume',dest="resume", metavar='int', choices=[0,1], type=int, default=0,
+                help="continue the run from the last checkpoint in OUTPUT_FILE.ckpt (default 0)")
     args = parser.parse_args()
 
     params = vars(args)
@@ -53,41 +73,168 @@ def read_params(args):
     return params
 
 
+def test_feats(feats,cls,subclass_sl,class_hierarchy,params,kw_done=None,wilc_done=None):
+    # KW and Wilcoxon tests of the features in feats, returns the feature names
+    # (in order) with the KW outcome, the KW p-value and the Wilcoxon outcome
+    # (None if the Wilcoxon test has not been performed). kw_done and
+    # wilc_done are the KW p-values and the Wilcoxon outcomes already known
+    # (from a stage file) for some features, they are not tested again
+    fk = list(feats.keys())
+    kw_done = kw_done if kw_done else {}
+    wilc_done = wilc_done if wilc_done else {}
+    if params['engine'] != 'r':
+        test_kw,test_wilcoxon = (test_kw_native,test_wilcoxon_native) if params['engine'] == 'native' else (test_kw_rbatch,test_wilcoxon_rbatch)
+        if all([k in kw_done for k in fk]): kw_pvs = numpy.array([kw_done[k] for k in fk],dtype=float)
+        else: kw_oks,kw_pvs = test_kw(cls,feats.data,params['anova_alpha'],sorted(cls.keys()))
+        kw_oks = kw_pvs < params['anova_alpha']
+        kw_sel = numpy.array([i for i in numpy.flatnonzero(kw_oks) if fk[i] not in wilc_done],dtype=int)
+        wilc_pvs = test_wilcoxon(subclass_sl,class_hierarchy,feats.data[kw_sel],params['min_c'],params['only_same_subcl']) if params['wilc'] and len(kw_sel) else {}
+        wilc_ind = dict([(fk[i],j) for j,i in enumerate(kw_sel)])
+    res = []
+    for i,feat_name in enumerate(fk):
+        if params['engine'] != 'r': kw_ok,pv = bool(kw_oks[i]),float(kw_pvs[i])
+        elif feat_name in kw_done: kw_ok,pv = kw_done[feat_name] < params['anova_alpha'],kw_done[feat_name]
+        else: kw_ok,pv = test_kw_r(cls,feats[feat_name],params['anova_alpha'],sorted(cls.keys()))
+        wilc_ok = None
+        if kw_ok and params['wilc'] and feat_name in wilc_done:
+            wilc_ok = wilc_done[feat_name]
+        elif kw_ok and params['wilc']:
+            pvs = dict([(p,v[wilc_ind[feat_name]]) for p,v in wilc_pvs.items()]) if params['engine'] != 'r' else None
+            wilc_ok = test_rep_wilcoxon_r(subclass_sl,class_hierarchy,feats[feat_name],params['wilcoxon_alpha'],params['multiclass_strat'],params['strict'],feat_name,params['min_c'],params['only_same_subcl'],params['curv'],pvs)
+        res.append((feat_name,kw_ok,pv,wilc_ok))
+    return res
+
+def init_worker(names,ref,cls,subclass_sl,class_hierarchy,params,kw_done,wilc_done):
+    # the workers attach to the feature matrix (see share_matrix) and test
+    # the row ranges they receive
+    global worker_data
+    worker_data = FeatureMatrix(names,attach_matrix(ref)),cls,subclass_sl,class_hierarchy,params,kw_done,wilc_done
+
+def test_feats_worker(bounds):
+    feats = worker_data[0]
+    return test_feats(FeatureMatrix(feats.names[bounds[0]:bounds[1]],feats.data[bounds[0]:bounds[1]]),*worker_data[1:])
+
+# the parameters the outputs of each stage depend on
+stage_params = {'kw':['engine'],
+                'wilc':['wilcoxon_alpha','multiclass_strat','strict','min_c','only_same_subcl','curv','engine'],
+                'lda':['n_boots','f_boots','seed','engine']}
+
+def reusable_stage(stages,s,params):
+    # the stored outputs of stage s if they were computed with the same parameters
+    if s in stages and stages[s]['params'] == dict([(k,params[k]) for k in stage_params[s]]): return stages[s]
+    return None
+
+# the parameters that change the content of the result file
+cache_params = ['anova_alpha','wilcoxon_alpha','lda_abs_th','nlogs','wilc','rank_tec','svm_norm','n_boots','only_same_subcl',
+                'curv','f_boots','strict','min_c','multiclass_strat','seed','engine']
+
 def lefse_run():
     init()
     params = read_params(sys.argv)
+    outputs = [('.res',params['output_file'])]+([('.bin',params['output_bin'])] if params['output_bin'] else [])
+    if params['cache_dir']:
+        key = cache_key(params['input_file'],dict([(k,params[k]) for k in cache_params]))
+        if cache_get(params['cache_dir'],key,outputs,params['cache_max_age']):
+            print("Result read from the cache in",params['cache_dir'])
+            return
     feats,cls,class_sl,subclass_sl,class_hierarchy = load_data(params['input_file'])
     kord,cls_means = get_class_means(class_sl,feats)
+    fk = list(feats.keys())
+    stages = {}
+    ckpt_file = params['output_file']+'.ckpt'
+    if params['stages'] or params['checkpoint'] > 0.0 or params['resume']:
+        input_hash = file_hash(params['input_file'])
+    if params['stages']:
+        stages = load_stages(params['stages'],input_hash)
+    if params['resume']:
+        ckpt = load_stages(ckpt_file,input_hash)
+        if not ckpt: print("No usable checkpoint in",ckpt_file,"- starting from the beginning")
+        stages.update(ckpt)
+    kw_st,wilc_st = reusable_stage(stages,'kw',params),reusable_stage(stages,'wilc',params)
+    kw_done = dict([(fk[i],pv) for i,pv in zip(kw_st['ind'].tolist(),kw_st['pv'].tolist())]) if kw_st else {}
+    wilc_done = dict([(fk[i],bool(ok)) for i,ok in zip(wilc_st['ind'].tolist(),wilc_st['ok'].tolist())]) if wilc_st else {}
+
+    last_ckpt = [time.time()]
+    def checkpoint():
+        # the outputs computed so far are saved at most every params['checkpoint'] seconds
+        if params['checkpoint'] > 0.0 and time.time()-last_ckpt[0] >= params['checkpoint']:
+            save_stages(ckpt_file,input_hash,stages)
+            last_ckpt[0] = time.time()
+
+    def update_test_stages(tests):
+        kw_done.update([(t[0],t[2]) for t in tests])
+        wilc_done.update([(t[0],t[3]) for t in tests if t[3] is not None])
+        stages['kw'] = {'params':dict([(k,params[k]) for k in stage_params['kw']]),
+                        'ind':numpy.array([feats.index[k] for k in kw_done],dtype=numpy.int64),'pv':numpy.array(list(kw_done.values()),dtype=float)}
+        stages['wilc'] = {'params':dict([(k,params[k]) for k in stage_params['wilc']]),
+                          'ind':numpy.array([feats.index[k] for k in wilc_done],dtype=numpy.int64),'ok':numpy.array(list(wilc_done.values()),dtype=bool)}
+
     wilcoxon_res = {}
     kw_n_ok = 0
     nf = 0
-    for feat_name,feat_values in list(feats.items()):
+    # the features are tested in contiguous shards (smaller ones when the
+    # run is checkpointed), the results are merged in order
+    nsh = min(len(fk),params['nproc']*4) if params['nproc'] > 1 else 1
+    if params['checkpoint'] > 0.0: nsh = max(nsh,min(len(fk),(len(fk)+999)//1000))
+    shards = [(len(fk)*i//nsh,len(fk)*(i+1)//nsh) for i in range(nsh)]
+    tests = []
+    if params['nproc'] > 1:
+        ref,blocks = share_matrix(feats.data)
+        try:
+            with multiprocessing.get_context('spawn').Pool(params['nproc'],init_worker,(fk,ref,cls,subclass_sl,class_hierarchy,params,kw_done,wilc_done)) as pool:
+                for r in pool.imap(test_feats_worker,shards):
+                    tests += r
+                    update_test_stages(r)
+                    checkpoint()
+        finally:
+            release_shared(blocks)
+    else:
+        for a,b in shards:
+            r = test_feats(FeatureMatrix(fk[a:b],feats.data[a:b]),cls,subclass_sl,class_hierarchy,params,kw_done,wilc_done)
+            tests += r
+            update_test_stages(r)
+            checkpoint()
+    sel = []
+    for feat_name,kw_ok,pv,wilc_ok in tests:
         if params['verbose']:
             print("Testing feature",str(nf),": ",feat_name)
             nf += 1
-        kw_ok,pv = test_kw_r(cls,feat_values,params['anova_alpha'],sorted(cls.keys()))
         if not kw_ok:
             if params['verbose']: print("\tkw ko")
-            del feats[feat_name]
             wilcoxon_res[feat_name] = "-"
             continue
         if params['verbose']: print("\tkw ok\t")
 
-        if not params['wilc']: continue
+        if not params['wilc']:
+            sel.append(feat_name)
+            continue
         kw_n_ok += 1
-        res_wilcoxon_rep = test_rep_wilcoxon_r(subclass_sl,class_hierarchy,feat_values,params['wilcoxon_alpha'],params['multiclass_strat'],params['strict'],feat_name,params['min_c'],params['only_same_subcl'],params['curv'])
-        wilcoxon_res[feat_name] = str(pv) if res_wilcoxon_rep else "-"
-        if not res_wilcoxon_rep:
+        wilcoxon_res[feat_name] = str(pv) if wilc_ok else "-"
+        if not wilc_ok:
             if params['verbose']: print("wilc ko")
-            del feats[feat_name]
-        elif params['verbose']: print("wilc ok\t")
+        else:
+            sel.append(feat_name)
+            if params['verbose']: print("wilc ok\t")
+    sel_ind = numpy.array([feats.index[k] for k in sel],dtype=numpy.int64)
+    feats = feats.subset(sel).dense()
+    lda_sd = {}
 
     if len(feats) > 0:
         print("Number of significantly discriminative features:", len(feats), "(", kw_n_ok, ") before internal wilcoxon")
         if params['lda_abs_th'] < 0.0:
             lda_res,lda_res_th = dict([(k,0.0) for k,v in feats.items()]), dict([(k,v) for k,v in feats.items()])
         else:
-            if params['rank_tec'] == 'lda': lda_res,lda_res_th = test_lda_r(cls,feats,class_sl,params['n_boots'],params['f_boots'],params['lda_abs_th'],0.0000000001,params['nlogs'])
+            if params['rank_tec'] == 'lda':
+                lda_st = reusable_stage(stages,'lda',params)
+                done = lda_st['scores'] if lda_st and numpy.array_equal(lda_st['ind'],sel_ind) else None
+                def lda_checkpoint(scores):
+                    stages['lda'] = {'params':dict([(k,params[k]) for k in stage_params['lda']]),'ind':sel_ind,'scores':scores}
+                    checkpoint()
+                scores = lda_boot_scores(cls,feats,params['n_boots'],params['f_boots'],0.0000000001,params['engine'],params['seed'],params['nproc'],done,
+                                         lda_checkpoint if params['checkpoint'] > 0.0 else None)
+                stages['lda'] = {'params':dict([(k,params[k]) for k in stage_params['lda']]),'ind':sel_ind,'scores':scores}
+                lda_res,lda_res_th = lda_effect_sizes(feats.keys(),scores,params['lda_abs_th'])
+                lda_sd = lda_boot_sd(feats.keys(),scores)
             elif params['rank_tec'] == 'svm': lda_res,lda_res_th = test_svm(cls,feats,class_sl,params['n_boots'],params['f_boots'],params['lda_abs_th'],0.0,params['svm_norm'])
             else: lda_res,lda_res_th = dict([(k,0.0) for k,v in feats.items()]), dict([(k,v) for k,v in feats.items()])
     else:
@@ -102,6 +249,17 @@ def lefse_run():
     outres['wilcox_res'] = wilcoxon_res
     print("Number of discriminative features with abs LDA score >",params['lda_abs_th'],":",len(lda_res_th))
     save_res(outres,params["output_file"])
+    if params['output_bin']:
+        outres['kw_pv'] = dict([(t[0],t[2]) for t in tests])
+        outres['wilc_ok'] = dict([(t[0],-1 if t[3] is None else int(bool(t[3]))) for t in tests])
+        outres['lda_sd'] = lda_sd
+        save_res_bin(outres,params['output_bin'])
+    if params['stages']: save_stages(params['stages'],input_hash,stages)
+    # the checkpoint and the temporary files of interrupted checkpoint writes
+    ckpt_dir = os.path.dirname(ckpt_file) or '.'
+    for e in os.listdir(ckpt_dir):
+        if e == os.path.basename(ckpt_file) or e.startswith(os.path.basename(ckpt_file)+'.tmp'): os.remove(os.path.join(ckpt_dir,e))
+    if params['cache_dir']: cache_put(params['cache_dir'],key,outputs,params['cache_max_size'],params['cache_max_age'])
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
+from lefse.compressed import open_compressed
 
 def read_params(args):
     import argparse as ap
@@ -47,7 +48,7 @@ def qiime2lefse():
     fout = pars['out']
     all_md = not pars['c'] and not pars['s'] and not pars['u']
     sel_md = [pars['c'],pars['s'],pars['u']]
-    with (fin if fin==sys.stdin else open(fin)) as inpf :
+    with (fin if fin==sys.stdin else open_compressed(fin)) as inpf :
         lines = [list(ll) for ll in 
                     (zip(*[l.strip().split('\t') 
                         for l in inpf.readlines()[1:]]) ) ]
@@ -59,7 +60,7 @@ def qiime2lefse():
     
     md = {}
     if fmd:
-        with open(fmd) as inpf:
+        with open_compressed(fmd) as inpf:
             mdlines = [l.strip().split('\t') for l in inpf.readlines()]
   
         mdf = mdlines[0][1:]
@@ -80,7 +81,7 @@ def qiime2lefse():
             continue
         out_m.append( [md[k][kmd] for kmd in selected_md] + list(v) )
 
-    with (fout if fout == sys.stdout else open( fout, "w" )) as outf:
+    with (fout if fout == sys.stdout else open_compressed( fout, "wt" )) as outf:
         for l in zip(*out_m):
             outf.write( "\t".join(l) + "\n" )
 
@@ -44,6 +44,7 @@ import re
 import scipy.stats
 import string
 from .ValidateData import ValidateData
+from lefse.compressed import open_compressed, compression, uncompressed_name
 
 
 #*************************************************************
@@ -296,6 +297,17 @@ class AbundanceTable:
         #    Check if file is a biom file - if so invoke the biom routine               #
         #################################################################################
         strFileName = xInputFile if isinstance(xInputFile, str) else xInputFile.name
+        strTableName = str(xInputFile)
+        istmCompressed = None
+
+        #################################################################################
+        #    Compressed (gz, bz2, xz) files are decompressed on the fly, their format   #
+        #    is given by the file name without the compression extension                #
+        #################################################################################
+        if isinstance(xInputFile, str) and compression(xInputFile) is not None:
+            strFileName = uncompressed_name(xInputFile)
+            if not (strFileName.endswith(ConstantsBreadCrumbs.c_strBiomFile) or (strFormat == ConstantsBreadCrumbs.c_strBiomFile)):
+                xInputFile = istmCompressed = open_compressed(xInputFile)
 
                 # Determine the file read function by file extension
         if strFileName.endswith(ConstantsBreadCrumbs.c_strBiomFile) or (strFormat == ConstantsBreadCrumbs.c_strBiomFile):
@@ -315,14 +327,19 @@ class AbundanceTable:
                 lContents = False
         elif( strFileName.endswith(ConstantsBreadCrumbs.c_strPCLFile) or (strFormat == ConstantsBreadCrumbs.c_strPCLFile) ):    
             #Read in from text file to create the abundance and metadata structures
-            lContents = AbundanceTable._funcTextToStructuredArray(xInputFile=xInputFile, cDelimiter=cDelimiter,
-                sMetadataID = sMetadataID, sLastMetadataRow = sLastMetadataRow, sLastMetadata = sLastMetadata, ostmOutputFile = outputFile)
+            try:
+                lContents = AbundanceTable._funcTextToStructuredArray(xInputFile=xInputFile, cDelimiter=cDelimiter,
+                    sMetadataID = sMetadataID, sLastMetadataRow = sLastMetadataRow, sLastMetadata = sLastMetadata, ostmOutputFile = outputFile)
+            finally:
+                #The decompressing stream opened above is closed once read
+                if istmCompressed: istmCompressed.close()
         else:    
             print("I do not understand the format to read and write the data as, please use the correct file extension or indicate a type.")
+            if istmCompressed: istmCompressed.close()
             return( false )
 
         #If contents is not a false then set contents to appropriate objects
-        return AbundanceTable(npaAbundance=lContents[0], dictMetadata=lContents[1], strName=str(xInputFile), strLastMetadata=sLastMetadata, rwmtRowMetadata = lContents[2],
+        return AbundanceTable(npaAbundance=lContents[0], dictMetadata=lContents[1], strName=strTableName, strLastMetadata=sLastMetadata, rwmtRowMetadata = lContents[2],
         dictFileMetadata = lContents[3], lOccurenceFilter = lOccurenceFilter, cFileDelimiter=cDelimiter, cFeatureNameDelimiter=cFeatureNameDelimiter) if lContents else False
 
     #Testing Status: Light happy path testing
@@ -2222,9 +2239,54 @@ class AbundanceTable:
                 
     #*******************************************
     #* biom interface functions:               *
-    #* 1. _funcBiomToStructuredArray           *
-    #* 2. _funcDecodeBiomMetadata              *
+    #* 1. funcReadBiomTable                    *
+    #* 2. funcGetBiomSampleMetadata            *
+    #* 3. _funcBiomToStructuredArray           *
+    #* 4. _funcDecodeBiomMetadata              *
     #*******************************************    
+    @staticmethod
+    def funcReadBiomTable(xInputFile = None):
+        """
+        Reads a biom file, compressed (gz, bz2, xz) or not, into a biom table object.
+
+        :param    xInputFile:    File path of biom file to read (or a biom table, which is returned as is).
+        :type:    String    File path.
+        :return:   The biom table
+        :type:    biom Table
+        """
+
+        if not isinstance(xInputFile, str):
+            return xInputFile
+        if compression(xInputFile) is not None:
+            with open_compressed(xInputFile) as istmBiom:
+                return parse_biom_table(istmBiom)
+        return load_table(xInputFile)
+
+    @staticmethod
+    def _funcBiomSampleEntries(BiomTable):
+        """
+        The id and metadata of each sample (column) of a biom table, as _funcDecodeBiomMetadata reads them.
+        """
+
+        ColumnsMetadata = BiomTable.metadata(axis='sample')
+        if ColumnsMetadata is None: ColumnsMetadata = [None] * len(BiomTable.ids(axis='sample'))
+        return [{ConstantsBreadCrumbs.c_id_lowercase:str(sSampleName), ConstantsBreadCrumbs.c_metadata_lowercase:None if ColumnMetadataEntry is None else dict(ColumnMetadataEntry)}
+                for sSampleName, ColumnMetadataEntry in zip(BiomTable.ids(axis='sample'), ColumnsMetadata)]
+
+    @staticmethod
+    def funcGetBiomSampleMetadata(BiomTable):
+        """
+        Returns the sample metadata of a biom table as the AbundanceTable built from it holds it,
+        without building the abundance structured array.
+
+        :param    BiomTable:    The biom table.
+        :type:    biom Table
+        :return    Metadata:    {"ID":[value,value...], metadata name:[value,value...]}
+        :type:    dict()
+        """
+
+        return AbundanceTable._funcDecodeBiomMetadata(dict(), AbundanceTable._funcBiomSampleEntries(BiomTable))[ConstantsBreadCrumbs.c_Metadata]
+
     @staticmethod
     def _funcBiomToStructuredArray(xInputFile = None):    
         """
@@ -2245,62 +2307,53 @@ class AbundanceTable:
         #*******************************************
         try:
 
-            BiomTable = load_table(xInputFile) if isinstance(xInputFile, str) else xInputFile    #Import the biom file
+            BiomTable = AbundanceTable.funcReadBiomTable(xInputFile)    #Import the biom file
         except:
             print("Failure decoding biom file - please check your input biom file and rerun")
             BiomCommonArea = None
             return BiomCommonArea
  
         BiomCommonArea = dict()        
-        dBugNames = list()            #Bug Names Table
         dRowsMetadata = None        #Initialize the np.array of the Rows metadata
-        BiomElements  =  json.loads(BiomTable.to_json(''))
-        for BiomKey, BiomValue in BiomElements.items():
+
         #****************************************************
-        #*     Checking the different keys:  format,        *
-        #*     rows, columns, date, generated_by            *
+        #*     The ids, the metadata and the matrix are      *
+        #*     read directly from the table object (no JSON  *
+        #*     serialization of the table), the file info    *
+        #*     keys are the ones to_json would write         *
         #****************************************************
-            if (BiomKey == ConstantsBreadCrumbs.c_strFormatKey  
-            or BiomKey == ConstantsBreadCrumbs.c_strFormatUrl  
-            or BiomKey == ConstantsBreadCrumbs.c_MatrixTtype
-            or BiomKey == ConstantsBreadCrumbs.c_strTypekey
-            or BiomKey == ConstantsBreadCrumbs.c_strIDKey #Same as below
-            or BiomKey == ConstantsBreadCrumbs.c_GeneratedBy  #<---Need to follow up with Biom as always BiomValue = "" even though in the file has a value
-            or BiomKey == ConstantsBreadCrumbs.c_strDateKey):  #Same as above
-                BiomCommonArea = AbundanceTable._funcInsertKeyToCommonArea(BiomCommonArea, BiomKey, BiomValue)
-
-
-            if BiomKey == ConstantsBreadCrumbs.c_rows:
-                iMaxIdLen = 0 
-                for iIndexRowMetaData in range(0, len(BiomValue)):
-                    if ConstantsBreadCrumbs.c_id_lowercase in BiomValue[iIndexRowMetaData]:
-                        sBugName = BiomValue[iIndexRowMetaData][ConstantsBreadCrumbs.c_id_lowercase]
-                        dBugNames.append(sBugName)      #Post to the bug table
-                        if len(sBugName) > iMaxIdLen:    #We  are calculating dynamically the length of the ID
-                            iMaxIdLen  =  len(sBugName)
-        
-                if ConstantsBreadCrumbs.c_metadata_lowercase in BiomValue[0] and BiomValue[0][ConstantsBreadCrumbs.c_metadata_lowercase] != None :
-                     dRowsMetadata = AbundanceTable._funcBiomBuildRowMetadata(BiomValue,  iMaxIdLen )
+        for BiomKey, BiomValue in [(ConstantsBreadCrumbs.c_strIDKey, BiomTable.table_id),
+                                   (ConstantsBreadCrumbs.c_strFormatKey, "Biological Observation Matrix 1.0.0"),
+                                   (ConstantsBreadCrumbs.c_strFormatUrl, "http://biom-format.org"),
+                                   (ConstantsBreadCrumbs.c_MatrixTtype, "sparse"),
+                                   (ConstantsBreadCrumbs.c_GeneratedBy, ""),
+                                   (ConstantsBreadCrumbs.c_strDateKey, date.today().isoformat()),
+                                   (ConstantsBreadCrumbs.c_strTypekey, BiomTable.type)]:
+            BiomCommonArea = AbundanceTable._funcInsertKeyToCommonArea(BiomCommonArea, BiomKey, BiomValue)
+
+        dBugNames = [str(sBugName) for sBugName in BiomTable.ids(axis='observation')]    #Bug Names Table
+        iMaxIdLen = max([len(sBugName) for sBugName in dBugNames]) if dBugNames else 0    #We  are calculating dynamically the length of the ID
+        RowsMetadata = BiomTable.metadata(axis='observation')
+        if dBugNames and RowsMetadata is not None and RowsMetadata[0] is not None:
+            dRowsMetadata = AbundanceTable._funcBiomBuildRowMetadata([{ConstantsBreadCrumbs.c_id_lowercase:sBugName, ConstantsBreadCrumbs.c_metadata_lowercase:dict(RowMetadataEntry)}
+                                                                      for sBugName, RowMetadataEntry in zip(dBugNames, RowsMetadata)], iMaxIdLen)
+
+        BiomCommonArea = AbundanceTable._funcDecodeBiomMetadata(BiomCommonArea,
+            AbundanceTable._funcBiomSampleEntries(BiomTable), iMaxIdLen)    #Call the subroutine to Build the metadata
 
- 
-            if BiomKey == ConstantsBreadCrumbs.c_columns:
-                BiomCommonArea = AbundanceTable._funcDecodeBiomMetadata(BiomCommonArea, BiomValue, iMaxIdLen)    #Call the subroutine to Build the metadata
- 
-     
         #*******************************************
         #* Build the TaxData                       *
         #*******************************************
-    
-        BiomTaxDataWork = list()            #Initlialize TaxData
-        BiomObservations = BiomTable.iter(axis='observation')        #Invoke biom method to fetch data from the biom file
-        for BiomObservationData in BiomObservations:
-            sBugName = BiomObservationData[1]
-            BiomTaxDataEntry = [sBugName]
-            BiomObservationsValues = BiomObservationData[0]
-            BiomTaxDataEntry.extend(BiomObservationsValues.tolist())
-            BiomTaxDataWork.append(tuple(BiomTaxDataEntry))    
-    
-        BiomCommonArea[ConstantsBreadCrumbs.c_BiomTaxData] = np.array(BiomTaxDataWork,dtype=np.dtype(BiomCommonArea[ConstantsBreadCrumbs.c_Dtype]))
+
+        #* The structured array is filled one sample (column of the sparse  *
+        #* matrix) at a time, without Python objects for the single values  *
+        BiomTaxData = np.zeros(len(dBugNames), dtype=np.dtype(BiomCommonArea[ConstantsBreadCrumbs.c_Dtype]))
+        BiomTaxData[ConstantsBreadCrumbs.c_ID] = dBugNames
+        BiomMatrix = BiomTable.matrix_data.tocsc()
+        for iIndexSample, (sSampleName, sType) in enumerate(BiomCommonArea[ConstantsBreadCrumbs.c_Dtype][1:]):
+            BiomTaxData[sSampleName] = BiomMatrix[:,iIndexSample].toarray().ravel()
+
+        BiomCommonArea[ConstantsBreadCrumbs.c_BiomTaxData] = BiomTaxData
         BiomCommonArea[ConstantsBreadCrumbs.c_dRowsMetadata] = RowMetadata(dRowsMetadata)
         del(BiomCommonArea[ConstantsBreadCrumbs.c_Dtype])            #Not needed anymore
  
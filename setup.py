@@ -3,7 +3,7 @@ from setuptools.command.install import install
 from io import open
 import os
 
-install_requires = ["numpy", "matplotlib", "biom-format", "rpy2"]
+install_requires = ["numpy", "scipy", "matplotlib", "biom-format", "rpy2"]
 setuptools.setup(
     name='lefse',
     version='1.1.2',
@@ -0,0 +1,53 @@
+import numpy
+import scipy.sparse
+import scipy.stats
+
+from lefse import lefse
+
+
+def tied_table():
+    # features x samples with ties, zeros, negative values and all-tied rows
+    rng = numpy.random.default_rng(0)
+    x = rng.integers(-3, 4, (40, 23)).astype(float)
+    x[rng.random(x.shape) < 0.5] = 0.0
+    x[5] = 0.0
+    x[6] = 2.5
+    x[7, :] = 0.0
+    x[7, 4] = -1.5
+    return x
+
+
+def expected(test, x, groups):
+    # the scipy p-value of each row, NaN where all the values are tied
+    pv = []
+    for row in x:
+        if len(numpy.unique(row)) < 2:
+            pv.append(float('nan'))
+        else:
+            pv.append(test(*[row[g] for g in groups]))
+    return numpy.array(pv)
+
+
+def test_kw_native_matches_scipy():
+    x = tied_table()
+    cls = {'class': ['a'] * 8 + ['b'] * 9 + ['c'] * 6}
+    groups = [numpy.arange(0, 8), numpy.arange(8, 17), numpy.arange(17, 23)]
+    ref = expected(lambda *g: scipy.stats.kruskal(*g).pvalue, x, groups)
+    for feats in (x, scipy.sparse.csr_matrix(x)):
+        ok, pv = lefse.test_kw_native(cls, feats, 0.05, ['class'], block=16)
+        numpy.testing.assert_allclose(pv, ref, rtol=1e-10, atol=1e-14)
+        numpy.testing.assert_array_equal(ok, ref < 0.05)
+
+
+def test_wilcoxon_native_matches_scipy():
+    x = tied_table()
+    sl = {'a_s1': (0, 5), 'a_s2': (5, 11), 'b_s1': (11, 17), 'b_s2': (17, 23)}
+    cl_hie = {'a': ['a_s1', 'a_s2'], 'b': ['b_s1', 'b_s2']}
+    mwu = lambda a, b: scipy.stats.mannwhitneyu(a, b, use_continuity=False, method='asymptotic').pvalue
+    for feats in (x, scipy.sparse.csr_matrix(x)):
+        pvs = lefse.test_wilcoxon_native(sl, cl_hie, feats, 3, False, block=16)
+        assert sorted(pvs) == [('a_s1', 'b_s1'), ('a_s1', 'b_s2'), ('a_s2', 'b_s1'), ('a_s2', 'b_s2')]
+        for (k1, k2), pv in pvs.items():
+            both = numpy.r_[numpy.arange(*sl[k1]), numpy.arange(*sl[k2])]
+            ref = numpy.array([mwu(r[slice(*sl[k1])], r[slice(*sl[k2])]) if len(numpy.unique(r[both])) > 1 else float('nan') for r in x])
+            numpy.testing.assert_allclose(pv, ref, rtol=1e-10, atol=1e-14)
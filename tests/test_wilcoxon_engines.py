@@ -0,0 +1,20 @@
+import numpy
+import pytest
+
+from lefse import lefse
+
+pytest.importorskip("rpy2")
+
+
+def test_wilcoxon_rbatch_matches_native():
+    # two classes with two subclasses each, values with ties
+    rng = numpy.random.default_rng(0)
+    feats = rng.integers(0, 6, (20, 24)).astype(float)
+    feats[:5, 12:] += 3.0
+    sl = {'a_s1': (0, 7), 'a_s2': (7, 12), 'b_s1': (12, 18), 'b_s2': (18, 24)}
+    cl_hie = {'a': ['a_s1', 'a_s2'], 'b': ['b_s1', 'b_s2']}
+    native = lefse.test_wilcoxon_native(sl, cl_hie, feats, 3, False)
+    rbatch = lefse.test_wilcoxon_rbatch(sl, cl_hie, feats, 3, False)
+    assert sorted(native) == sorted(rbatch)
+    for pr in native:
+        numpy.testing.assert_allclose(rbatch[pr], native[pr], rtol=1e-8)